@@ -0,0 +1,224 @@
+import sys
+import time
+import pandas as pd
+from argparse import ArgumentParser
+from pathlib import Path
+from collections import defaultdict
+from contextual_cosine_sim import SimRunner, contextualSim
+from detector import file_finder, gold_sent_idxs
+from helpers.timestamp import name_timestamp
+
+# The threshold tester is imported from the repository root as src.helpers, so
+# it never shares the helpers name with the detector helpers in this folder
+sys.path.append(str(Path(__file__).resolve().parents[2]))
+from src.helpers.threshold_tester import ContextualThres
+
+
+def arg_parser():
+    parser = ArgumentParser()
+
+    parser.add_argument(
+        '-be',
+        '--backend',
+        type=str,
+        choices=['int8', 'onnx'],
+        default='int8',
+        help='Choose the CPU backend that is compared to fp32 (default: int8)'
+    )
+
+    parser.add_argument(
+        '-g',
+        '--gold_data',
+        type=str,
+        default='../../data/context_gold_edits.tsv',
+        help='Give the contextual gold data, the report only scores its '
+             'sentences (default: ../../data/context_gold_edits.tsv)'
+    )
+
+    parser.add_argument(
+        '-hl',
+        '--human_label',
+        type=str,
+        default='label_context',
+        help='The column of the gold data with the human labels '
+             '(default: label_context)'
+    )
+
+    parser.add_argument(
+        '-th',
+        '--thresholds',
+        type=float,
+        nargs='+',
+        default=[.4, .45, .5, .55, .6],
+        help='The thresholds that are tested with both backends '
+             '(default: 0.4 0.45 0.5 0.55 0.6)'
+    )
+
+    parser.add_argument(
+        '-di',
+        '--data_input',
+        type=str,
+        default='../../data/2_new_run',
+        help='Give a data input, which is the root file for genre output '
+             '(default: ../../data/2_new_run)'
+    )
+
+    parser.add_argument(
+        '-mt',
+        '--machine_translation',
+        action='store_true',
+        help='Tell the system you are using machine translation data (default: False)'
+    )
+
+    parser.add_argument(
+        '-bs',
+        '--batch_size',
+        type=int,
+        default=32,
+        help='The maximum number of sentence pairs in a single forward pass '
+             '(default: 32)'
+    )
+
+    parser.add_argument(
+        '-ls',
+        '--layer_strat',
+        type=str,
+        choices=['last_hidden', 'second_to_last', 'conc_last4'],
+        default='last_hidden',
+        help='Choose the layer strategy for the word embeddings (default: last_hidden)'
+    )
+
+    parser.add_argument(
+        '-sp',
+        '--subword_pool',
+        type=str,
+        choices=['first', 'mean', 'max'],
+        default='first',
+        help='Choose how the subword embeddings of a word are pooled '
+             '(default: first)'
+    )
+
+    args = parser.parse_args()
+    return args
+
+
+def gold_triples(gold_data:str, sent_pair_files, sent_wa_files, data_input:str):
+    '''Returns a list with the film path, sentence index and
+    (source, target, alignments) triple of every gold sentence of the
+    given files in a given data input (see gold_sent_idxs).
+    '''
+    runner = SimRunner(None)
+
+    gold_rows = []
+    for text_path, aw_path, film_idxs in zip(*gold_sent_idxs(gold_data,
+                                                            sent_pair_files,
+                                                            sent_wa_files,
+                                                            data_input)):
+        text_list, aw_list, film_idxs = runner.line_loader(text_path, aw_path, film_idxs)
+        for sent_pair, aligns, sent_idx in zip(text_list, aw_list, film_idxs):
+            gold_rows.append((text_path.as_posix(), sent_idx, runner.sent_triple(sent_pair, aligns)))
+
+    return gold_rows
+
+
+def score_gold(embedder:contextualSim, gold_rows:list):
+    '''Returns a detector style dataframe with the scores of a given
+    embedder for the gold sentences, and the seconds it took to score
+    them.
+    '''
+    start = time.perf_counter()
+    sent_dicts = embedder.context_emb_batch([triple for _, _, triple in gold_rows],
+                                            as_dict=True)
+    seconds = time.perf_counter() - start
+
+    columns = defaultdict(list)
+    for (film, sent_idx, _), pd_dict in zip(gold_rows, sent_dicts):
+        if pd_dict is None:
+            continue
+        n_words = len(pd_dict['cosine_w'])
+        for key, value in pd_dict.items():
+            columns[key].extend(value if isinstance(value, list) else [value] * n_words)
+        columns['film'].extend([film] * n_words)
+        columns['sent_idx'].extend([sent_idx] * n_words)
+
+    return pd.DataFrame.from_dict(columns), seconds
+
+
+def score_drift(fp32:pd.Series, quant:pd.Series) -> dict:
+    '''Returns the absolute differences and correlations between the
+    fp32 scores and the scores of another backend.
+    '''
+    diff = (fp32 - quant).abs()
+    return {
+        'max_abs_diff': diff.max(),
+        'mean_abs_diff': diff.mean(),
+        'pearson': fp32.corr(quant),
+        'spearman': fp32.corr(quant, method='spearman'),
+    }
+
+
+def threshold_scores(df:pd.DataFrame, args) -> pd.DataFrame:
+    '''Returns the macro averaged scores per threshold and threshold
+    metric of the ThresholdFinder for a given scored dataframe.
+    '''
+    finder = ContextualThres(thresholds=args.thresholds,
+                             gold_data=args.gold_data,
+                             human_label=args.human_label)
+    finder(df.copy())
+    finder.score()
+    return finder.comp_df
+
+
+def main():
+    args = arg_parser()
+    sent_pair_files, sent_wa_files = file_finder(args)
+    gold_rows = gold_triples(args.gold_data, sent_pair_files, sent_wa_files, args.data_input)
+
+    scores = {}
+    seconds = {}
+    for backend in ['fp32', args.backend]:
+        embedder = contextualSim(layer_strat=args.layer_strat,
+                                 batch_size=args.batch_size,
+                                 subword_pool=args.subword_pool,
+                                 backend=backend,
+                                 onnx_dir=args.data_input)
+        scores[backend], seconds[backend] = score_gold(embedder, gold_rows)
+
+    fp32_df = scores['fp32']
+    quant_df = scores[args.backend]
+    sent_cols = ['film', 'sent_idx', 'cosine_sent']
+    drift = pd.DataFrame({
+        'cosine_w': score_drift(fp32_df.cosine_w, quant_df.cosine_w),
+        'cosine_sent': score_drift(fp32_df[sent_cols].drop_duplicates().cosine_sent,
+                                   quant_df[sent_cols].drop_duplicates().cosine_sent),
+    }).T
+
+    fp32_f1 = threshold_scores(fp32_df, args)
+    quant_f1 = threshold_scores(quant_df, args)
+    best = fp32_f1[fp32_f1['f1-score'] == fp32_f1['f1-score'].max()].iloc[[0]]
+    best_threshold, best_metric = best.index[0], best.iloc[0].t_metric
+    at_best = quant_f1[(quant_f1.index == best_threshold) & (quant_f1.t_metric == best_metric)]
+    f1 = pd.DataFrame({
+        'fp32 best f1': [best.iloc[0]['f1-score']],
+        f'{args.backend} f1 at fp32 best': [at_best.iloc[0]['f1-score']],
+        f'{args.backend} best f1': [quant_f1['f1-score'].max()],
+        'threshold': [best_threshold],
+        't_metric': [best_metric],
+        'fp32 seconds': [seconds['fp32']],
+        f'{args.backend} seconds': [seconds[args.backend]],
+    })
+
+    print(f'Score drift of {args.backend} against fp32 on {len(gold_rows)} gold sentences')
+    print(drift)
+    print(f1.T)
+
+    if args.machine_translation:
+        out_stem = f'{args.data_input}/{name_timestamp()}-context_drift_{args.backend}_mt'
+    else:
+        out_stem = f'{args.data_input}/{name_timestamp()}-context_drift_{args.backend}'
+    drift.to_csv(f'{out_stem}.tsv', sep='\t')
+    f1.to_csv(f'{out_stem}_f1.tsv', sep='\t')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,108 @@
 from typing import Any
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha1
+from inspect import signature
+from pathlib import Path
+import multiprocessing
+from multiprocessing.util import Finalize
+import json
+import transformers
 from transformers import AutoTokenizer, AutoModel
 import torch
 import numpy as np
 import pandas as pd
 import jenkspy
-from statistics import mean
-from collections import Counter
+from collections import Counter, defaultdict
+from embedding_cache import embeddingCache
+from helpers.natural_breaks import sentenceGroups
+
+
+class onnxEncoder():
+    '''A class used to run a transformer encoder as an ONNX graph with
+    onnxruntime on the CPU.
+
+    The graph is exported once to the given path (and reused if it
+    already exists) and returns the last hidden layer and all hidden
+    states, so it can be called like the torch model it replaces. See
+    onnx_name for a file name that changes with the model revision and
+    library versions, so a stale graph is never reused.
+    '''
+    def __init__(self, model, tokenizer, onnx_path) -> None:
+        '''Initializes an inference session for a given torch model and
+        tokenizer, exporting the model to the ONNX path if needed.
+        '''
+        import onnxruntime
+
+        forward_args = signature(model.forward).parameters
+        self.input_names = [name for name in tokenizer.model_input_names
+                            if name in forward_args]
+        self.onnx_path = Path(onnx_path)
+        if not self.onnx_path.exists():
+            self._export(model, tokenizer)
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = torch.get_num_threads()
+        self.session = onnxruntime.InferenceSession(str(self.onnx_path), options,
+                                                    providers=['CPUExecutionProvider'])
+        self.feed_names = [i.name for i in self.session.get_inputs()]
+
+    def _export(self, model, tokenizer):
+        '''Exports a given model to the ONNX path of the object with a
+        dynamic batch size and sequence length.
+        '''
+        input_names = self.input_names
+
+        class hiddenStates(torch.nn.Module):
+            def __init__(self, model) -> None:
+                super().__init__()
+                self.model = model
+
+            def forward(self, *inputs):
+                out = self.model(**dict(zip(input_names, inputs)), return_dict=False)
+                return (out[0], *out[1])
+
+        sample = tokenizer(['an example sentence', 'another one'],
+                           padding=True, return_tensors='pt').to('cpu')
+        n_states = model.config.num_hidden_layers + 1
+        self.onnx_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.onnx_path.with_suffix('.tmp')
+        torch.onnx.export(hiddenStates(model).eval(),
+                          tuple(sample[name] for name in input_names),
+                          str(tmp_path),
+                          input_names=input_names,
+                          output_names=['last_hidden_state'] + [f'hidden_state_{i}'
+                                                                for i in range(n_states)],
+                          dynamic_axes={name: {0: 'batch', 1: 'tokens'}
+                                        for name in input_names},
+                          dynamo=False)
+        tmp_path.replace(self.onnx_path)
+
+    def __call__(self, **inputs):
+        '''Returns the last hidden layer and a tuple of all hidden
+        states as torch tensors for given tokenizer outputs.
+        '''
+        out = self.session.run(None, {name: inputs[name].cpu().numpy()
+                                      for name in self.feed_names})
+        out = [torch.from_numpy(i) for i in out]
+        return out[0], tuple(out[1:])
+
+
+def onnx_name(model) -> str:
+    '''Returns the file name of the ONNX graph of a given torch model,
+    with a hash of the model revision (the commit of a hub model, or
+    the size and modification time of the files of a local model) and
+    the versions of the libraries that export the graph.
+    '''
+    import onnx
+
+    model_name = model.config.name_or_path
+    revision = getattr(model.config, '_commit_hash', None)
+    if revision is None and Path(model_name).is_dir():
+        revision = sorted((path.name, path.stat().st_size, path.stat().st_mtime_ns)
+                          for path in Path(model_name).iterdir() if path.is_file())
+    key = json.dumps([model_name, revision, transformers.__version__,
+                      torch.__version__, onnx.__version__])
+    return f'{Path(model_name).name}.{sha1(key.encode("utf-8")).hexdigest()[:12]}.onnx'
 
 
 class contextualSim():
@@ -13,12 +110,66 @@ class contextualSim():
     def __init__(self,
                  model_name:str='sentence-transformers/distiluse-base-multilingual-cased-v2',
                  layer_strat='last_hidden',
-                 alt=False) -> None:
-        self.dev = self.gpu_checker()
+                 alt=False,
+                 batch_size=32,
+                 subword_pool='first',
+                 cache_dir=None,
+                 cache_bytes=8 * 1024 ** 3,
+                 cache_readonly=False,
+                 backend='fp32',
+                 onnx_dir=None) -> None:
+        '''Initializes the embedder for a given model and settings.
+
+        backend chooses how the model is run: fp32 (the torch model on
+        the GPU if available), int8 (dynamically quantized linear
+        layers on the CPU) or onnx (an exported graph run by
+        onnxruntime on the CPU, stored in onnx_dir, by default in the
+        cache_dir or else the working directory, see onnx_name).
+        '''
+        # Stored so worker processes can build the same embedder
+        self.init_kwargs = {
+            'model_name': model_name,
+            'layer_strat': layer_strat,
+            'alt': alt,
+            'batch_size': batch_size,
+            'subword_pool': subword_pool,
+            'cache_dir': cache_dir,
+            'cache_bytes': cache_bytes,
+            'cache_readonly': cache_readonly,
+            'backend': backend,
+            'onnx_dir': onnx_dir,
+        }
+        self.backend = backend
+        self.dev = self.gpu_checker(cpu_override=backend != 'fp32')
         self.tokenizer = AutoTokenizer.from_pretrained(model_name)
         self.model = AutoModel.from_pretrained(model_name, output_hidden_states=True).to(self.dev).eval()
-        self.layer_strat = layer_strat
+        if backend == 'int8':
+            self.model = torch.ao.quantization.quantize_dynamic(self.model,
+                                                                {torch.nn.Linear},
+                                                                dtype=torch.qint8)
+        elif backend == 'onnx':
+            if onnx_dir is None:
+                onnx_dir = '.' if cache_dir is None else cache_dir
+            self.model = onnxEncoder(self.model, self.tokenizer,
+                                     Path(onnx_dir) / onnx_name(self.model))
+        elif backend != 'fp32':
+            raise ValueError(f'Unknown backend: {backend}')
+        # A list of layer strategies is run from a single forward pass,
+        # the first strategy is used for cosine_w and the labels
+        if isinstance(layer_strat, str):
+            layer_strat = [layer_strat]
+        self.layer_strats = list(layer_strat)
+        self.layer_strat = self.layer_strats[0]
         self.alt = alt
+        self.batch_size = batch_size
+        self.subword_pool = subword_pool
+        self.cache = None
+        if cache_dir is not None:
+            # Quantized embeddings are cached apart from the fp32 ones
+            cache_model = model_name if backend == 'fp32' else f'{model_name}@{backend}'
+            self.cache = embeddingCache(cache_dir, cache_model, self.layer_strat,
+                                        max_bytes=cache_bytes,
+                                        readonly=cache_readonly)
 
     def gpu_checker(self, cpu_override=False):
         '''Checking for the GPU availability'''
@@ -41,79 +192,280 @@ class contextualSim():
         sum_mask = torch.clamp(input_mask_expanded.sum(1), min=1e-9)
         return sum_embeddings / sum_mask
 
-    def _word_tensor_processing(self, model_output, token_id):
-        '''The word embeddings are retrieved by using a layer strategy
-        (such as last hidden and second to last hidden layer) after
-        which token id is used to return the specific word embedding that
-        is required.
+    def _layer_embeddings(self, model_output, layer_strat=None):
+        '''Returns the token embeddings of a (batched) model output
+        using a given layer strategy (such as last hidden and second to
+        last hidden layer), defaulting to the layer strategy that has
+        been set in the object.
         '''
-        if self.layer_strat == 'last_hidden':
+        if layer_strat is None:
+            layer_strat = self.layer_strat
+
+        if layer_strat == 'last_hidden':
             token_embeddings = model_output[0]
-        elif self.layer_strat == 'second_to_last':
+        elif layer_strat == 'second_to_last':
             hidden_states = model_output[1]
             token_embeddings = torch.stack(hidden_states[2:]).sum(0)
-        elif self.layer_strat == 'conc_last4':
+        elif layer_strat == 'conc_last4':
             hidden_states = model_output[1]
             token_embeddings = torch.cat([hidden_states[i]
                                           for i in [-1, -2, -3, -4]],
                                           dim=-1)
+        else:
+            raise ValueError(f'Unknown layer strategy: {layer_strat}')
 
-        token_embeddings = token_embeddings.squeeze()[token_id[0][0]]
         return token_embeddings
 
+    def _word_tensor_processing(self, model_output, token_id, batch_idx=0):
+        '''The word embeddings are retrieved by using a layer strategy
+        (such as last hidden and second to last hidden layer) after
+        which token id is used to return the specific word embedding that
+        is required for the sentence at the given batch index.
+        '''
+        token_embeddings = self._layer_embeddings(model_output)
+        token_embeddings = token_embeddings[batch_idx][token_id[0][0]]
+        return token_embeddings
+
+    def _tokenize(self, sents):
+        '''Returns the padded tokenizer output for a given list of
+        sentences.
+        '''
+        return self.tokenizer(sents,
+                              padding=True,
+                              truncation=True,
+                              max_length=128,
+                              return_tensors='pt').to(self.dev)
+
     def context_emb(self, src_sent:str, tgt_sent:str, aligns:str):
         '''A language model is used with pytorch to return a dataframe
         with a sentence cosine distance score and word level cosine
         distance scores for a given source sentence, target sentence
         and word alignments.
         '''
-        pd_dict = {
-            'src_sent': src_sent,
-            'tgt_sent': tgt_sent,
-            'aligns': aligns,
-            'src': [],
-            'tgt': [],
-            'cosine_w': [],
-            'cosine_sent': 0,
-        }
-
-        aligns = [[int(i) for i in pair.split('-')] for pair in aligns.split(' ')]
-        tok_sys = lambda sent : self.tokenizer(sent,
-                                          padding=True,
-                                          truncation=True,
-                                          max_length=128,
-                                          return_tensors='pt').to(self.dev)
-
-        src_tok = tok_sys(src_sent)
-        tgt_tok = tok_sys(tgt_sent)
-
-        with torch.no_grad():
-            src_out = self.model(**src_tok)
-            tgt_out = self.model(**tgt_tok)
+        df = self.context_emb_batch([(src_sent, tgt_sent, aligns)])[0]
+        if df is None:
+            raise ValueError(f'Could not score: {src_sent} ||| {tgt_sent} ({aligns})')
+
+        return df
+
+    def context_emb_batch(self, sent_triples:list, batch_size:int=None, as_dict=False):
+        '''Returns a list of dataframes (see context_emb) for a given
+        list of (source sentence, target sentence, word alignments)
+        triples.
+
+        The sentence pairs are padded together and all sources and
+        targets of a batch are run through the model in a single
+        forward pass. Pairs that could not be scored (for example
+        because an alignment points past the truncated tokens) are
+        returned as None. If as_dict is true, the column dictionaries
+        are returned instead of dataframes.
+        '''
+        if batch_size is None:
+            batch_size = self.batch_size
 
-        src_embs_s = self._mean_pooling(src_out, src_tok['attention_mask'])
-        tgt_embs_s = self._mean_pooling(tgt_out, tgt_tok['attention_mask'])
-        dist_sent = float(1 - torch.cosine_similarity(src_embs_s.reshape(1,-1), tgt_embs_s.reshape(1,-1)))
-        pd_dict['cosine_sent'] = dist_sent
+        sent_dicts = []
+        for b_start in range(0, len(sent_triples), batch_size):
+            batch = sent_triples[b_start:b_start + batch_size]
+            sent_dicts.extend(self._context_emb_batch(batch))
 
-        for src, tgt in aligns:
-            pd_dict['src'].append(src_sent.split(' ')[src])
-            pd_dict['tgt'].append(tgt_sent.split(' ')[tgt])
+        if as_dict:
+            return sent_dicts
 
-            src_tok_id = np.where(np.array(src_tok.word_ids()) == src)
-            tgt_tok_id = np.where(np.array(tgt_tok.word_ids()) == tgt)
+        return [None if pd_dict is None else pd.DataFrame.from_dict(pd_dict)
+                for pd_dict in sent_dicts]
 
+    def _word_ids(self, tok, n_sents):
+        '''Returns a tensor (sentences x tokens) with the word index of
+        every subword token of the tokenizer output, -1 for special
+        and padding tokens.
+        '''
+        return torch.tensor([[-1 if w is None else w for w in tok.word_ids(batch_index=i)]
+                             for i in range(n_sents)],
+                            dtype=torch.long)
+
+    def _pool_words(self, token_embeddings, token_word_idx, n_total_words):
+        '''Returns the word embeddings (words x hidden) for a flat
+        tensor of token embeddings (tokens x hidden) and a flat tensor
+        with the word index of every token (-1 for tokens that do not
+        belong to a word), pooling the subwords of a word using the
+        subword pooling strategy (first, mean or max) that has been set
+        in the object. Additionally returns a mask of the words that
+        have at least one subword token.
+        '''
+        in_word = token_word_idx >= 0
+        token_embeddings = token_embeddings[in_word]
+        token_word_idx = token_word_idx[in_word]
+        n_subwords = torch.zeros(n_total_words, dtype=torch.long, device=token_word_idx.device)
+        n_subwords.index_add_(0, token_word_idx, torch.ones_like(token_word_idx))
+
+        if self.subword_pool == 'first':
+            positions = torch.arange(len(token_word_idx), device=token_word_idx.device)
+            first = torch.full((n_total_words,), len(token_word_idx), dtype=torch.long,
+                               device=token_word_idx.device)
+            first = first.scatter_reduce(0, token_word_idx, positions, reduce='amin')
+            first = first.clamp(max=max(len(token_word_idx) - 1, 0))
+            word_embeddings = token_embeddings[first]
+        elif self.subword_pool in ('mean', 'max'):
+            reduce = 'mean' if self.subword_pool == 'mean' else 'amax'
+            index = token_word_idx.unsqueeze(-1).expand_as(token_embeddings)
+            word_embeddings = torch.zeros((n_total_words, token_embeddings.shape[-1]),
+                                          dtype=token_embeddings.dtype,
+                                          device=token_embeddings.device)
+            word_embeddings = word_embeddings.scatter_reduce(0, index, token_embeddings,
+                                                             reduce=reduce,
+                                                             include_self=False)
+        else:
+            raise ValueError(f'Unknown subword pooling strategy: {self.subword_pool}')
 
-            src_embs = self._word_tensor_processing(src_out, src_tok['attention_mask'], src_tok_id)
-            tgt_embs = self._word_tensor_processing(tgt_out, tgt_tok['attention_mask'], tgt_tok_id)
+        return word_embeddings, n_subwords > 0
 
-            dist_w = round(float(1 - torch.cosine_similarity(src_embs.reshape(1,-1), tgt_embs.reshape(1,-1))), 17)
+    def _encode(self, sents):
+        '''Returns a list with the token embeddings (tokens x hidden)
+        per layer strategy, the word id per token (-1 for special tokens)
+        and the sentence embedding of every given sentence.
 
-            src_tgt = '{} <-> {}'.format(pd_dict['src'][-1], pd_dict['tgt'][-1])
+        Identical sentences are only encoded once and, if the object
+        has an embedding cache, sentences are read from the cache and
+        only the missing ones are run through the model (in a single
+        forward pass) and stored.
+        '''
+        to_tensor = lambda arr : torch.from_numpy(np.array(arr)).to(self.dev)
+
+        encoded = {}
+        for sent in dict.fromkeys(sents):
+            if self.cache is not None:
+                cached = {strat: self.cache.get(sent, strat) for strat in self.layer_strats}
+                if all(i is not None for i in cached.values()):
+                    _, word_ids, embs_s = cached[self.layer_strat]
+                    encoded[sent] = ({strat: to_tensor(i[0]) for strat, i in cached.items()},
+                                     to_tensor(word_ids),
+                                     to_tensor(embs_s))
+
+        missing = [sent for sent in dict.fromkeys(sents) if sent not in encoded]
+        if missing:
+            tok = self._tokenize(missing)
+
+            with torch.no_grad():
+                out = self.model(**tok)
+
+            embs_s = self._mean_pooling(out, tok['attention_mask'])
+            token_embeddings = {strat: self._layer_embeddings(out, strat)
+                                for strat in self.layer_strats}
+            word_ids = self._word_ids(tok, len(missing)).to(self.dev)
+            n_tokens = tok['attention_mask'].sum(1).tolist()
+
+            for i, sent in enumerate(missing):
+                encoded[sent] = ({strat: token_embs[i, :n_tokens[i]]
+                                  for strat, token_embs in token_embeddings.items()},
+                                 word_ids[i, :n_tokens[i]],
+                                 embs_s[i])
+                if self.cache is not None:
+                    for strat in self.layer_strats:
+                        self.cache.put(sent,
+                                       encoded[sent][0][strat].cpu().numpy(),
+                                       encoded[sent][1].cpu().numpy(),
+                                       encoded[sent][2].cpu().numpy(),
+                                       layer_strat=strat)
+
+        return [encoded[sent] for sent in sents]
+
+    def _context_emb_batch(self, batch):
+        '''Returns a list of column dictionaries for a single batch of
+        sentence triples using one forward pass of the model.
+
+        The word embeddings of all aligned word pairs in the batch are
+        gathered in one indexed operation and their distances are
+        computed with a single batched cosine similarity per layer
+        strategy. If the object has multiple layer strategies, a
+        cosine_w_<strategy> column is added for every strategy.
+        '''
+        n_pairs = len(batch)
+        sents = [src for src, _, _ in batch] + [tgt for _, tgt, _ in batch]
+        encoded = self._encode(sents)
+
+        embs_s = torch.stack([sent_emb for _, _, sent_emb in encoded])
+        dists_sent = (1 - torch.cosine_similarity(embs_s[:n_pairs], embs_s[n_pairs:])).tolist()
+
+        # Map every token to a word index that is unique over the whole batch
+        n_tokens = torch.tensor([len(w_ids) for _, w_ids, _ in encoded], device=self.dev)
+        token_sent_idx = torch.arange(len(encoded), device=self.dev).repeat_interleave(n_tokens)
+        word_ids = torch.cat([w_ids for _, w_ids, _ in encoded])
+        n_words = torch.zeros(len(encoded), dtype=torch.long, device=self.dev)
+        n_words = n_words.scatter_reduce(0, token_sent_idx, word_ids + 1, reduce='amax')
+        word_offsets = torch.cumsum(n_words, 0) - n_words
+        token_word_idx = torch.where(word_ids >= 0, word_ids + word_offsets[token_sent_idx], -1)
+        word_embeddings = {}
+        for strat in self.layer_strats:
+            word_embeddings[strat], has_tokens = self._pool_words(
+                torch.cat([token_embs[strat] for token_embs, _, _ in encoded]),
+                token_word_idx,
+                int(n_words.sum()),
+            )
+        word_offsets = word_offsets.tolist()
+        n_words = n_words.tolist()
+        has_tokens = has_tokens.tolist()
+
+        links_src = []
+        links_tgt = []
+        sent_links = []
+        for pair_idx, (src_sent, tgt_sent, aligns) in enumerate(batch):
+            try:
+                align_pairs = np.array(aligns.replace('-', ' ').split(' '), dtype=int).reshape(-1, 2)
+                src_n = min(n_words[pair_idx], len(src_sent.split(' ')))
+                tgt_n = min(n_words[n_pairs + pair_idx], len(tgt_sent.split(' ')))
+                src_idx = align_pairs[:, 0] + word_offsets[pair_idx]
+                tgt_idx = align_pairs[:, 1] + word_offsets[n_pairs + pair_idx]
+                if ((align_pairs < 0).any()
+                    or (align_pairs[:, 0] >= src_n).any()
+                    or (align_pairs[:, 1] >= tgt_n).any()
+                    or not all(has_tokens[i] for i in src_idx)
+                    or not all(has_tokens[i] for i in tgt_idx)):
+                    raise IndexError(f'Alignment out of range: {aligns}')
+            except Exception:
+                sent_links.append(None)
+                continue
 
-            pd_dict['cosine_w'].append(dist_w)
+            links_src.append(src_idx)
+            links_tgt.append(tgt_idx)
+            sent_links.append(align_pairs)
+
+        dists_w = {}
+        if links_src:
+            links_src = torch.from_numpy(np.concatenate(links_src)).to(self.dev)
+            links_tgt = torch.from_numpy(np.concatenate(links_tgt)).to(self.dev)
+            for strat, word_embs in word_embeddings.items():
+                dists_w[strat] = (1 - torch.cosine_similarity(word_embs[links_src],
+                                                              word_embs[links_tgt])).tolist()
+
+        sent_dicts = []
+        link_start = 0
+        for pair_idx, (src_sent, tgt_sent, aligns) in enumerate(batch):
+            align_pairs = sent_links[pair_idx]
+            if align_pairs is None:
+                sent_dicts.append(None)
+                continue
 
-        return pd.DataFrame.from_dict(pd_dict)
+            src_words = src_sent.split(' ')
+            tgt_words = tgt_sent.split(' ')
+            link_end = link_start + len(align_pairs)
+            pd_dict = {
+                'src_sent': src_sent,
+                'tgt_sent': tgt_sent,
+                'aligns': aligns,
+                'src': [src_words[src] for src, _ in align_pairs],
+                'tgt': [tgt_words[tgt] for _, tgt in align_pairs],
+                'cosine_w': [round(dist_w, 17)
+                             for dist_w in dists_w[self.layer_strat][link_start:link_end]],
+                'cosine_sent': dists_sent[pair_idx],
+            }
+            if len(self.layer_strats) > 1:
+                for strat in self.layer_strats:
+                    pd_dict[f'cosine_w_{strat}'] = [round(dist_w, 17)
+                                                    for dist_w in dists_w[strat][link_start:link_end]]
+            sent_dicts.append(pd_dict)
+            link_start = link_end
+
+        return sent_dicts
 
     def find_label(self, num):
         '''Returns a label based on a given score number
@@ -149,61 +501,25 @@ class contextualSim():
         otherwise uses the word level cosine distance for labeling
         the majority group.
         '''
-        self.threshold = threshold
-        grp = df_sent.cosine_w.to_list()
-        unique_scores = set(grp)
-
-        if simple_thres:
-            df_sent['labels'] = [self.find_label(i.cosine_w) for idx, i in df_sent.iterrows()]
+        df_sent['labels'] = self.find_group_labels(df_sent.cosine_w.to_list(),
+                                                   df_sent.cosine_sent.unique()[0],
+                                                   threshold,
+                                                   sent_sim=sent_sim,
+                                                   simple_thres=simple_thres)
+        return df_sent
 
-        else:
-            if len(unique_scores) == 1:
-                df_sent['labels'] = self.find_label(list(unique_scores)[0])
-            else:
-                try:
-                    breaks = jenkspy.jenks_breaks(grp, n_classes=2)
-                except Exception:
-                    print(f'JENKSPY_ERROR: {grp}')
-                groups = [breaks[i:i+2] for i in range(len(breaks)) if not i + 2 > len(breaks)]
-
-                lst = []
-                for idx, i in df_sent.iterrows():
-                    for j_idx, mima_i in enumerate(groups):
-                        if j_idx == 0 and mima_i[0] <= i.cosine_w <= mima_i[1]:
-                            lst.append('lower')
-                        elif mima_i[0] < i.cosine_w <= mima_i[1]:
-                            lst.append('higher')
-                df_sent['groups'] = lst
-
-                major_group = Counter(lst).most_common(1)[0][0]
-
-                if sent_sim:
-                    major_label = self.find_label(df_sent.cosine_sent.unique()[0])
-                else:
-                    major_label = self.find_label(mean(df_sent[df_sent.groups == major_group].cosine_w.to_list()))
-
-                if major_label == 'creative shift':
-                    if major_group == 'higher':
-                        minor_label = 'reproduction'
-                    else:
-                        minor_label = 'creative shift'
-                else:
-                    if major_group == 'higher':
-                        minor_label = 'reproduction'
-                    else:
-                        minor_label = 'creative shift'
-
-                group_labels = []
-                for idx, i in df_sent.iterrows():
-                    if i.groups == major_group:
-                        group_labels.append(major_label)
-                    else:
-                        group_labels.append(minor_label)
-                df_sent['labels'] = group_labels
-
-                df_sent.drop(['groups'], axis=1, inplace=True)
+    def find_group_labels(self, grp, cosine_sent, threshold, sent_sim=False, simple_thres=False):
+        '''Returns a list of labels for the word level cosine scores of
+        a sentence, given its sentence cosine score and a threshold.
+        See find_groups for the options.
+        '''
+        self.threshold = threshold
+        groups = sentenceGroups(grp, cosine_sent=[cosine_sent] * len(grp))
+        if groups.failed.any() and not simple_thres:
+            print(f'JENKSPY_ERROR: {grp}')
+            raise ValueError(f'Could not find the natural breaks of {grp}')
 
-        return df_sent
+        return groups.labels(threshold, sent_sim=sent_sim, simple_thres=simple_thres)
 
 
 class SimRunner():
@@ -238,7 +554,51 @@ class SimRunner():
 
         return text_list, aw_list
 
-    def iterator(self, text_list, aw_list, v1=False, threshold=0.6, simple_thres=False):
+    def line_loader(self, text_path, aw_path, sent_idxs):
+        '''Returns a list of sentences, a list of word alignments and a
+        list of sentence indices (see file_loader) for only the given
+        sentence indices of a text file path and word alignment path.
+        Both files are read line by line up to the last given index,
+        indices past the end of the files are left out.
+        '''
+        wanted = set(sent_idxs)
+        last = max(wanted, default=-1)
+
+        def read_lines(path, keep):
+            lines = {}
+            idx = 0
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    for part in line.splitlines():
+                        if not keep(part):
+                            continue
+                        if idx in wanted:
+                            lines[idx] = part
+                        idx += 1
+                        if idx > last:
+                            return lines
+            return lines
+
+        aw_lines = read_lines(aw_path, lambda aw : aw != '')
+        text_lines = read_lines(text_path, lambda sent_pair : not '' in sent_pair.split(' ||| '))
+
+        sent_idxs = [sent_idx for sent_idx in sent_idxs
+                     if sent_idx in aw_lines and sent_idx in text_lines]
+        text_list = [text_lines[sent_idx].split(' ||| ') for sent_idx in sent_idxs]
+        aw_list = [aw_lines[sent_idx] for sent_idx in sent_idxs]
+
+        return text_list, aw_list, sent_idxs
+
+    def sent_triple(self, sent_pair, aligns):
+        '''Returns a (source, target, alignments) triple for a given
+        sentence pair and word alignments, using an empty target if the
+        pair has no target sentence (such a pair is not scored).
+        '''
+        sent_pair = list(sent_pair) + ['', '']
+        return sent_pair[0], sent_pair[1], aligns
+
+    def iterator(self, text_list, aw_list, v1=False, threshold=0.6, simple_thres=False,
+                 sent_dicts=None, offset=0, sent_idxs=None):
         '''Returns a dataframe for a given list of sentences and word alignments.
         Additionally, three options exist to make changes to the processing.
 
@@ -248,36 +608,317 @@ class SimRunner():
         simple_thres dictates whether to use a majority minority
         grouping (false) or a simple above or below threshold labeling
         (true).
+
+        sent_dicts can be given to label already scored sentences
+        (one context_emb_batch column dictionary per sentence) instead
+        of running the embedder. offset is added to the sentence index
+        when only a part of a film is given, or sent_idxs can be given
+        with the sentence index of every given sentence.
+
+        The scores of every sentence are appended to column buffers,
+        from which a single dataframe is built for the film, after which
+        all of its sentences are labeled at once.
         '''
+        if sent_dicts is None:
+            sent_dicts = self.embedder.context_emb_batch(
+                [self.sent_triple(sent_pair, aligns)
+                 for sent_pair, aligns in zip(text_list, aw_list)],
+                as_dict=True
+            )
+
+        if sent_idxs is None:
+            sent_idxs = range(offset, offset + len(text_list))
+
+        columns = defaultdict(list)
         for idx, sent_pair in enumerate(text_list):
             try:
-                src_sent = sent_pair[0]
-                tgt_sent = sent_pair[1]
-                aligns = aw_list[idx]
-                if idx == 0:
-                    df = self.embedder.context_emb(src_sent, tgt_sent, aligns)
-                    df['film'] = self.film
-                    df['sent_idx'] = idx
-                    if v1:
-                        df['class'] = self.embedder.find_shift(df.cosine_w.to_list())
-                    else:
-                        df = self.embedder.find_groups(df, threshold, simple_thres=simple_thres)
-                else:
-                    df_c = self.embedder.context_emb(src_sent, tgt_sent, aligns)
-                    # df['film'] = self.film
-                    df_c['film'] = self.film
-                    df_c['sent_idx'] = idx
-                    if v1:
-                        df_c['class'] = self.embedder.find_shift(df_c.cosine_w.to_list())
-                    else:
-                        df_c = self.embedder.find_groups(df_c, threshold, simple_thres=simple_thres)
-                    df = pd.concat([df, df_c], ignore_index=True)
+                pd_dict = sent_dicts[idx]
+                if pd_dict is None or not pd_dict['cosine_w']:
+                    raise ValueError(f'Could not score sentence {idx}')
+                n_words = len(pd_dict['cosine_w'])
+                if v1:
+                    labels = self.embedder.find_shift(pd_dict['cosine_w'])
             except Exception:
-                print(self.film, '\n', idx, sent_pair)
+                print(self.film, '\n', sent_idxs[idx], sent_pair)
                 continue
 
+            for key, value in pd_dict.items():
+                columns[key].extend(value if isinstance(value, list) else [value] * n_words)
+            columns['film'].extend([self.film] * n_words)
+            columns['sent_idx'].extend([sent_idxs[idx]] * n_words)
+            if v1:
+                columns['class'].extend(labels)
+
+        df = pd.DataFrame.from_dict(columns)
+
+        if not v1 and len(df):
+            # All sentences are grouped and labeled at once
+            groups = sentenceGroups(df.cosine_w.to_numpy(),
+                                    df.sent_idx.to_numpy(),
+                                    df.cosine_sent.to_numpy())
+            df['labels'] = groups.labels(threshold, simple_thres=simple_thres)
+            if groups.failed.any() and not simple_thres:
+                sent_pairs = dict(zip(sent_idxs, text_list))
+                for sent_idx in groups.sent_codes[groups.failed]:
+                    print(self.film, '\n', sent_idx, sent_pairs[sent_idx])
+                df = df[~groups.failed[groups.row_sent]].reset_index(drop=True)
+
         if v1:
             for i in df.sent_idx.unique():
                 df_c = self.embedder.find_groups(df[df.sent_idx == i])
                 df = pd.concat([df, df_c], ignore_index=True)
-        return df
\ No newline at end of file
+        return df
+
+
+class CorpusRunner(SimRunner):
+    '''A class used to run the cosine similarity system over a whole
+    corpus, batching sentences of similar length across films.
+    '''
+    def __init__(self, embedder, max_tokens=4096, max_sentences=None,
+                 sort_kind='quicksort', pool_size=None, workers=1,
+                 threads_per_worker=None) -> None:
+        '''Initializes a corpus runner object for a given embedder,
+        a token budget per batch and an optional number of sentence
+        pairs per batch.
+
+        pool_size limits the number of sentences (in film order) that
+        are pooled and sorted by length at once, so that films and
+        checkpoint chunks are finished regularly during a run instead
+        of all at the end (default: the whole corpus).
+
+        With more than one worker, the batches are still made here,
+        exactly as in a serial run, and only scored in worker processes
+        that each load the embedder once and use threads_per_worker
+        intra-op threads. The workers store new sentences in the
+        embedding cache, which they save when they exit.
+        '''
+        super().__init__(embedder)
+        self.pool_size = pool_size
+        self.workers = workers
+        self.threads_per_worker = threads_per_worker
+        self.max_tokens = max_tokens
+        self.max_sentences = max_sentences
+        if self.max_tokens is None and self.max_sentences is None:
+            self.max_sentences = 1
+        self.sort_kind = sort_kind
+
+    def __call__(self, text_paths, aw_paths, threshold=0.6, simple_thres=False,
+                 progress=None, sent_idxs=None) -> list:
+        '''Returns a list with a labeled dataframe per film for the
+        given sentence pair files and word alignment files.
+
+        All sentence pairs of all films are pooled, sorted by length
+        and scored in batches, after which the scores are scattered
+        back to their (film, sent_idx) and labeled per film.
+        A progress wrapper (such as alive_it) can be given for the
+        batches, and sent_idxs limits the scored sentences of every
+        film (see iter_films).
+        '''
+        out_frames = [None] * len(text_paths)
+        for film_idx, df in self.iter_films(text_paths, aw_paths,
+                                            threshold=threshold,
+                                            simple_thres=simple_thres,
+                                            progress=progress,
+                                            sent_idxs=sent_idxs):
+            out_frames[film_idx] = df
+
+        return out_frames
+
+    def iter_films(self, text_paths, aw_paths, threshold=0.6, simple_thres=False,
+                   progress=None, checkpoint=None, chunk_size=None, sent_idxs=None):
+        '''Yields the film index and labeled dataframe of every film
+        as soon as all of its sentences have been scored (see __call__).
+
+        If a checkpoint (runCheckpoint) is given, every film is split
+        into chunks of chunk_size sentences which are stored as soon
+        as they are finished, and chunks that the checkpoint already
+        holds are not scored again.
+
+        If sent_idxs is given (a list of sentence indices per film),
+        only those sentences are read from the files and scored, for
+        example the sentences of the gold data.
+        '''
+        if sent_idxs is None:
+            films = [self.file_loader(text_path, aw_path)
+                     for text_path, aw_path in zip(text_paths, aw_paths)]
+            film_sent_idxs = [None] * len(films)
+        else:
+            films = []
+            film_sent_idxs = []
+            for text_path, aw_path, film_idxs in zip(text_paths, aw_paths, sent_idxs):
+                text_list, aw_list, film_idxs = self.line_loader(text_path, aw_path, film_idxs)
+                films.append((text_list, aw_list))
+                film_sent_idxs.append(film_idxs)
+        n_sents = [min(len(text_list), len(aw_list)) for text_list, aw_list in films]
+
+        chunks = {}
+        for film_idx, n_sent in enumerate(n_sents):
+            size = n_sent if chunk_size is None else chunk_size
+            for start in range(0, n_sent, max(size, 1)):
+                end = min(start + size, n_sent)
+                if checkpoint is None or not checkpoint.is_done(text_paths[film_idx], start, end):
+                    chunks[(film_idx, start)] = end
+
+        pooled = [(film_idx, sent_idx, start, self.sent_triple(films[film_idx][0][sent_idx],
+                                                               films[film_idx][1][sent_idx]))
+                  for (film_idx, start), end in chunks.items()
+                  for sent_idx in range(start, end)]
+
+        sent_dicts = [[None] * len(text_list) for text_list, _ in films]
+        chunk_frames = defaultdict(dict)
+        pending_chunks = Counter({key: end - key[1] for key, end in chunks.items()})
+        pending_films = Counter(film_idx for film_idx, _ in chunks)
+
+        def finish_chunk(film_idx, start):
+            text_list, aw_list = films[film_idx]
+            end = chunks[(film_idx, start)]
+            self.film = text_paths[film_idx]
+            df = self.iterator(text_list[start:end], aw_list[start:end],
+                               threshold=threshold,
+                               simple_thres=simple_thres,
+                               sent_dicts=sent_dicts[film_idx][start:end],
+                               offset=start,
+                               sent_idxs=None if film_sent_idxs[film_idx] is None
+                                         else film_sent_idxs[film_idx][start:end])
+            sent_dicts[film_idx][start:end] = [None] * (end - start)
+            if checkpoint is None:
+                chunk_frames[film_idx][start] = df
+            else:
+                checkpoint.add(text_paths[film_idx], start, end, df)
+
+        def finish_film(film_idx):
+            if checkpoint is not None:
+                return film_idx, checkpoint.film_frame(text_paths[film_idx])
+
+            frames = chunk_frames.pop(film_idx, {})
+            if not frames:
+                self.film = text_paths[film_idx]
+                return film_idx, self.iterator([], [], sent_dicts=[])
+            if len(frames) == 1:
+                return film_idx, frames[0]
+            return film_idx, pd.concat([frames[start] for start in sorted(frames)],
+                                       ignore_index=True)
+
+        for film_idx in range(len(films)):
+            if pending_films[film_idx] == 0:
+                yield finish_film(film_idx)
+
+        batches = [[window[i] for i in batch_indices]
+                   for window in self._make_windows(pooled)
+                   for batch_indices in self._make_batches([pooled[i][3] for i in window])]
+
+        for batch_indices, batch_dicts in self._score_batches(pooled, batches, progress):
+            finished = []
+            for i, pd_dict in zip(batch_indices, batch_dicts):
+                film_idx, sent_idx, start, _ = pooled[i]
+                sent_dicts[film_idx][sent_idx] = pd_dict
+                pending_chunks[(film_idx, start)] -= 1
+                if pending_chunks[(film_idx, start)] == 0:
+                    finished.append((film_idx, start))
+
+            for film_idx, start in sorted(finished):
+                finish_chunk(film_idx, start)
+                pending_films[film_idx] -= 1
+                if pending_films[film_idx] == 0:
+                    yield finish_film(film_idx)
+
+    def _score_batches(self, pooled, batches, progress=None):
+        '''Yields the indices and scored column dictionaries of the
+        given batches (lists of indices into the pooled sentences) in
+        order, scoring the batches in worker processes if the object has
+        more than one worker.
+        '''
+        if self.workers <= 1:
+            if progress is not None:
+                batches = progress(batches)
+            for batch_indices in batches:
+                yield batch_indices, self.embedder.context_emb_batch(
+                    [pooled[i][3] for i in batch_indices],
+                    batch_size=len(batch_indices),
+                    as_dict=True
+                )
+            return
+
+        threads = self.threads_per_worker
+        if threads is None:
+            threads = max(1, multiprocessing.cpu_count() // self.workers)
+        with ProcessPoolExecutor(max_workers=self.workers,
+                                 mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_worker,
+                                 initargs=(self.embedder.init_kwargs, threads)) as pool:
+            results = pool.map(_score_batch,
+                               [[pooled[i][3] for i in batch_indices] for batch_indices in batches])
+            if progress is not None:
+                results = progress(results, total=len(batches))
+            for batch_dicts, batch_indices in zip(results, batches):
+                yield batch_indices, batch_dicts
+
+    def _make_windows(self, pooled):
+        '''Returns lists of indices into the pooled sentences, splitting
+        them in order into windows of about pool_size sentences. A new
+        window is only started at the start of a chunk.
+        '''
+        if self.pool_size is None:
+            return [list(range(len(pooled)))]
+
+        windows = [[]]
+        for i, (film_idx, sent_idx, start, _) in enumerate(pooled):
+            if sent_idx == start and len(windows[-1]) >= self.pool_size:
+                windows.append([])
+            windows[-1].append(i)
+        return windows
+
+    def _make_batches(self, sent_triples):
+        '''Yields lists of indices into the given sentence triples,
+        sorted from long to short, so that each batch stays under
+        the token budget (both source and target are counted at the
+        length of the longer of the two) and the sentence limit.
+        '''
+        if not sent_triples:
+            return
+
+        tokenize = lambda sents : self.embedder.tokenizer(sents,
+                                                          truncation=True,
+                                                          max_length=128)['input_ids']
+        src_lens = np.array([len(i) for i in tokenize([src for src, _, _ in sent_triples])])
+        tgt_lens = np.array([len(i) for i in tokenize([tgt for _, tgt, _ in sent_triples])])
+        lengths = 2 * np.maximum(src_lens, tgt_lens)
+        indices = np.argsort(-lengths, kind=self.sort_kind)
+
+        batch_indices = []
+        ntokens = nsentences = 0
+        for i in indices:
+            if nsentences > 0 and (
+                (self.max_tokens is not None and ntokens + lengths[i] > self.max_tokens)
+                or (self.max_sentences is not None and nsentences == self.max_sentences)
+            ):
+                yield batch_indices
+                ntokens = nsentences = 0
+                batch_indices = []
+            batch_indices.append(int(i))
+            ntokens += lengths[i]
+            nsentences += 1
+        if nsentences > 0:
+            yield batch_indices
+
+
+_worker_embedder = None
+
+
+def _init_worker(init_kwargs, threads):
+    '''Loads the embedder of a worker process once, with a given number
+    of intra-op threads.
+    '''
+    global _worker_embedder
+    torch.set_num_threads(threads)
+    _worker_embedder = contextualSim(**init_kwargs)
+    if _worker_embedder.cache is not None:
+        # The cache also saves itself every save_every new sentences
+        Finalize(_worker_embedder.cache, _worker_embedder.cache.save, exitpriority=0)
+
+
+def _score_batch(batch):
+    '''Returns the scored column dictionaries of a given batch (a list
+    of sentence triples) in a worker process.
+    '''
+    return _worker_embedder.context_emb_batch(batch, batch_size=len(batch), as_dict=True)
@@ -1,11 +1,14 @@
+import multiprocessing
 import pandas as pd
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from contextual_cosine_sim import SimRunner, contextualSim
+from contextual_cosine_sim import CorpusRunner, contextualSim
 from static_cosine_sim import staticSim
 from helpers.timestamp import name_timestamp
+from helpers.output_sink import get_sink
+from helpers.checkpoint import runCheckpoint
 from alive_progress import alive_it
-from collections import defaultdict
 
 
 def arg_parser():
@@ -39,6 +42,36 @@ def arg_parser():
              '(default: ../../data/_embeddings/fasttext/cc.nl.300.mapped.emb)'
     )
 
+    parser.add_argument(
+        '-sd',
+        '--store_dtype',
+        type=str,
+        choices=['float32', 'float16'],
+        default=None,
+        help='Read the static embeddings from a memory mapped store of this '
+             'dtype next to the embedding files, which is converted once '
+             'if it does not exist (default: None, parse the text embeddings)'
+    )
+
+    parser.add_argument(
+        '-sc',
+        '--store_compression',
+        type=str,
+        default=None,
+        help='Read the static embeddings from a compressed store, which is '
+             'made once from the --store_dtype store: pca<dims> (such as '
+             'pca100), int8 or pca<dims>-int8 (default: None)'
+    )
+
+    parser.add_argument(
+        '-cv',
+        '--corpus_vocab',
+        action='store_true',
+        help='Only load the static embeddings of the aligned words of the '
+             'corpus, which are stored once per corpus in the data input '
+             'folder (default: False)'
+    )
+
     parser.add_argument(
         '-di',
         '--data_input',
@@ -56,6 +89,166 @@ def arg_parser():
 
     )
 
+    parser.add_argument(
+        '-bs',
+        '--batch_size',
+        type=int,
+        default=32,
+        help='The maximum number of sentence pairs that are run through '
+             'the contextual model in a single forward pass if -t=contextual '
+             '(default: 32)'
+    )
+
+    parser.add_argument(
+        '-mtok',
+        '--max_tokens',
+        type=int,
+        default=4096,
+        help='The maximum number of (padded) tokens in a single forward '
+             'pass if -t=contextual, sentences of all films are sorted '
+             'by length and batched under this budget (default: 4096)'
+    )
+
+    parser.add_argument(
+        '-ls',
+        '--layer_strat',
+        type=str,
+        nargs='+',
+        choices=['last_hidden', 'second_to_last', 'conc_last4'],
+        default=['last_hidden'],
+        help='Choose one or more layer strategies for the word embeddings '
+             'if -t=contextual, all strategies are taken from a single '
+             'forward pass and stored in a cosine_w_<strategy> column when '
+             'more than one is given, the first is used for cosine_w '
+             '(default: last_hidden)'
+    )
+
+    parser.add_argument(
+        '-sp',
+        '--subword_pool',
+        type=str,
+        choices=['first', 'mean', 'max'],
+        default='first',
+        help='Choose how the subword embeddings of a word are pooled '
+             'into a word embedding if -t=contextual (default: first)'
+    )
+
+    parser.add_argument(
+        '-g',
+        '--gold_data',
+        type=str,
+        default=None,
+        help='Give a gold tsv (with film and sent_idx columns) to only '
+             'score its sentences if -t=contextual, for example to tune '
+             'thresholds quickly (default: None, all sentences)'
+    )
+
+    parser.add_argument(
+        '-be',
+        '--backend',
+        type=str,
+        choices=['fp32', 'int8', 'onnx'],
+        default='fp32',
+        help='Choose how the contextual model is run if -t=contextual, '
+             'int8 (dynamically quantized) and onnx (onnxruntime) run on '
+             'the CPU, the onnx graph is stored in --cache_dir (or else in '
+             '--data_input), use backend_drift.py to check their scores '
+             'against fp32 on the gold data (default: fp32)'
+    )
+
+    parser.add_argument(
+        '-cd',
+        '--cache_dir',
+        type=str,
+        default=None,
+        help='Give a directory for an on-disk cache of the contextual '
+             'embeddings if -t=contextual, re-runs then read unchanged '
+             'sentences from the cache (default: None, no cache)'
+    )
+
+    parser.add_argument(
+        '-cgb',
+        '--cache_gb',
+        type=float,
+        default=8,
+        help='The size cap of the contextual embedding cache in GB, '
+             'least recently used sentences are evicted above it (default: 8)'
+    )
+
+    parser.add_argument(
+        '-of',
+        '--output_format',
+        type=str,
+        choices=['tsv', 'parquet'],
+        default='tsv',
+        help='Choose the output format, parquet output is a folder with '
+             'a file per film that is written as soon as the film is '
+             'finished (default: tsv)'
+    )
+
+    parser.add_argument(
+        '-oc',
+        '--output_compression',
+        type=str,
+        choices=['none', 'zstd', 'snappy', 'gzip'],
+        default='none',
+        help='Choose the compression of parquet output (default: none)'
+    )
+
+    parser.add_argument(
+        '-cs',
+        '--checkpoint_size',
+        type=int,
+        default=None,
+        help='Checkpoint the run in chunks of this many sentences per film '
+             '(whole films for -t=static), finished chunks are stored in a '
+             '.ckpt folder next to the output (default: None, no checkpoints)'
+    )
+
+    parser.add_argument(
+        '-r',
+        '--resume',
+        type=str,
+        default=None,
+        help='Give the timestamp of an interrupted checkpointed run '
+             '(for example 18102026_090311) to skip its finished chunks, '
+             'the other arguments have to be the same as in that run '
+             '(default: None)'
+    )
+
+    parser.add_argument(
+        '-ps',
+        '--pool_size',
+        type=int,
+        default=None,
+        help='The number of sentences (in film order) that are pooled and '
+             'sorted by length at once if -t=contextual, a smaller pool '
+             'finishes films and checkpoint chunks sooner (default: the '
+             'whole corpus, or 16 times --checkpoint_size if checkpointing)'
+    )
+
+    parser.add_argument(
+        '-w',
+        '--workers',
+        type=int,
+        default=1,
+        help='The number of worker processes that score the batches if '
+             '-t=contextual, the batches are made as in a serial run so the '
+             'output is the same, and the workers share the embedding '
+             'cache. With -t=static the workers score whole '
+             'films and share the memory mapped embedding store '
+             '(--store_dtype, float32 if not given) (default: 1)'
+    )
+
+    parser.add_argument(
+        '-tpw',
+        '--threads_per_worker',
+        type=int,
+        default=None,
+        help='The number of intra-op threads of every worker process '
+             '(default: the number of cores divided by --workers)'
+    )
+
     return parser.parse_args()
 
 
@@ -74,7 +267,7 @@ def wa_to_pairs(st_tt:str, wa:str):
                   for i in sent_pairs if '' not in i.split(' ||| ')]
 
     wa_idx_list = [
-        [[int(pair.split('-')[0]), int(pair.split('-')[1])] for pair in line]
+        [[int(pair.split('-')[0]), int(pair.split('-')[1])] for pair in line.split()]
         for line in wa_idx if line != ''
     ]
 
@@ -89,6 +282,22 @@ def wa_to_pairs(st_tt:str, wa:str):
     return all_pairs_list, sent_pairs
 
 
+def corpus_vocab(sent_pair_files, sent_wa_files):
+    '''Returns a set of all aligned source words and a set of all
+    aligned target words in a list of sentence pair files and sentence
+    word alignment files.
+    '''
+    src_words, tgt_words = set(), set()
+    for film, wa_file in zip(sent_pair_files, sent_wa_files):
+        wa_sent_pairs, _ = wa_to_pairs(film, wa_file)
+        for sent in wa_sent_pairs:
+            for src_w, tgt_w in sent:
+                src_words.add(src_w)
+                tgt_words.add(tgt_w)
+
+    return src_words, tgt_words
+
+
 def file_finder(args:arg_parser):
     '''Returns the sentence pair files and word alignment files
     as lists with Path file paths using arguments from the argparser.
@@ -106,6 +315,169 @@ def file_finder(args:arg_parser):
     return sent_pair_files, sent_wa_files
 
 
+def gold_sent_idxs(gold_data:str, sent_pair_files, sent_wa_files, data_input:str):
+    '''Returns the sentence pair files and word alignment files of the
+    films in a given gold tsv, and a list with the gold sentence
+    indices of every film. The film of a file is read from its path
+    relative to the given data input (genre/film_folder/...).
+
+    Raises a ValueError if no gold film has a file.
+    '''
+    gold = pd.read_csv(gold_data, sep='\t')
+    film_sents = gold.groupby('film').sent_idx.apply(lambda x : sorted(set(x)))
+
+    gold_pair_files, gold_wa_files, sent_idxs = [], [], []
+    for text_path, aw_path in zip(sent_pair_files, sent_wa_files):
+        film = Path(text_path).relative_to(data_input).parts[1].split('_')[0]
+        if film in film_sents:
+            gold_pair_files.append(text_path)
+            gold_wa_files.append(aw_path)
+            sent_idxs.append(film_sents[film])
+
+    if not gold_pair_files:
+        raise ValueError(f'None of the films of {gold_data} has a file in {data_input}')
+    missing = len(film_sents) - len(gold_pair_files)
+    if missing:
+        print(f'{missing} films of {gold_data} have no file in {data_input}')
+
+    return gold_pair_files, gold_wa_files, sent_idxs
+
+
+# The settings that change the output of each system, a resumed run has to match them
+STATIC_SETTINGS = ['source_emb', 'target_emb', 'store_dtype', 'store_compression',
+                   'machine_translation', 'checkpoint_size']
+CONTEXT_SETTINGS = ['machine_translation', 'batch_size', 'max_tokens', 'layer_strat',
+                    'subword_pool', 'gold_data', 'backend', 'checkpoint_size', 'pool_size']
+
+
+def open_checkpoint(args, out_stem, sink, settings):
+    '''Returns a runCheckpoint for a given output path stem and output
+    sink if the run is checkpointed (or resumed), otherwise returns None.
+    Only the given settings (those that change the output of the system,
+    see STATIC_SETTINGS and CONTEXT_SETTINGS) are checked on resume, so
+    a run can be resumed with another number of workers or cache.
+
+    Returns False if a resumed run has already finished the given output.
+    '''
+    if args.checkpoint_size is None and args.resume is None:
+        return None
+
+    config = {key: getattr(args, key) for key in settings}
+    for key in ['source_emb', 'target_emb', 'gold_data']:
+        if config.get(key) is not None:
+            config[key] = Path(config[key]).resolve().as_posix()
+    resume = args.resume is not None and Path(f'{out_stem}.ckpt/manifest.json').exists()
+    if args.resume is not None and not resume and sink.is_finished():
+        print(f'{sink.path} has already been finished')
+        return False
+
+    return runCheckpoint(out_stem, config, resume=resume, data_root=args.data_input)
+
+
+def static_frame(static:staticSim, film:Path, wa_sent_pairs, sent_pairs):
+    '''Returns a dataframe with the static cosine distance of every
+    aligned word pair of a given film, all pairs of the film are scored
+    at once (see staticSim.pair_cos).
+    '''
+    sent_idxs = [sent_idx for sent_idx, sent in enumerate(wa_sent_pairs) for _ in sent]
+    src_words = [pair[0] for sent in wa_sent_pairs for pair in sent]
+    tgt_words = [pair[1] for sent in wa_sent_pairs for pair in sent]
+    src_sents = [' '.join(sent_pair[0]) for sent_pair in sent_pairs]
+    tgt_sents = [' '.join(sent_pair[1]) for sent_pair in sent_pairs]
+
+    return pd.DataFrame({
+        'film': [film.as_posix().split('/')[5].split('_')[0]] * len(sent_idxs),
+        'genre': [film.as_posix().split('/')[4].lower()] * len(sent_idxs),
+        'sent_idx': sent_idxs,
+        'src_sent': [src_sents[sent_idx] for sent_idx in sent_idxs],
+        'tgt_sent': [tgt_sents[sent_idx] for sent_idx in sent_idxs],
+        'src': src_words,
+        'tgt': tgt_words,
+        'static_cosine': static.pair_cos(src_words, tgt_words),
+        'type': ['human'] * len(sent_idxs),
+    })
+
+
+def static_film(static:staticSim, film:Path, wa_file:Path):
+    '''Returns the number of sentences and the static dataframe (see
+    static_frame) of a given film and word alignment file.
+    '''
+    wa_sent_pairs, sent_pairs = wa_to_pairs(film, wa_file)
+    return len(wa_sent_pairs), static_frame(static, film, wa_sent_pairs, sent_pairs)
+
+
+def iter_static(static:staticSim, sent_pair_files, sent_wa_files, checkpoint=None, workers=1):
+    '''Yields the film, static dataframe, number of sentences and
+    whether the film was already finished in the checkpoint for every
+    given film in film order.
+
+    With more than one worker, the films are scored in worker processes
+    that share the memory mapped stores of the given staticSim object,
+    so the matrices are not copied. Forked workers inherit the object
+    (and its vocabulary) copy-on-write, spawned workers load it again.
+    Only a few films per worker are scored at once to bound the memory.
+    '''
+    global _worker_static
+    window = 1 if workers <= 1 else 4 * workers
+    pool = None
+    if workers > 1:
+        # Static workers never run torch, so they are forked (where possible)
+        # instead of spawned to skip importing the contextual models again
+        if 'fork' in multiprocessing.get_all_start_methods():
+            _worker_static = static
+            pool = ProcessPoolExecutor(max_workers=workers,
+                                       mp_context=multiprocessing.get_context('fork'))
+        else:
+            pool = ProcessPoolExecutor(max_workers=workers,
+                                       mp_context=multiprocessing.get_context('spawn'),
+                                       initializer=_init_static_worker,
+                                       initargs=(static.init_kwargs,))
+
+    try:
+        films = list(zip(sent_pair_files, sent_wa_files))
+        for w_start in range(0, len(films), window):
+            w_films = films[w_start:w_start + window]
+            finished = {}
+            if checkpoint:
+                for film, wa_file in w_films:
+                    n_sents = len(wa_to_pairs(film, wa_file)[0])
+                    if checkpoint.is_done(film, 0, n_sents):
+                        finished[film] = (checkpoint.film_frame(film), n_sents)
+
+            todo = [(film, wa_file) for film, wa_file in w_films if film not in finished]
+            if pool is None:
+                results = [static_film(static, *film_args) for film_args in todo]
+            else:
+                results = list(pool.map(_static_film, todo))
+            scored = {film: (df, n_sents) for (film, _), (n_sents, df) in zip(todo, results)}
+
+            for film, _ in w_films:
+                if film in finished:
+                    yield film, finished[film][0], finished[film][1], True
+                else:
+                    yield film, scored[film][0], scored[film][1], False
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        _worker_static = None
+
+
+_worker_static = None
+
+
+def _init_static_worker(init_kwargs):
+    '''Loads the staticSim object of a spawned worker process once.'''
+    global _worker_static
+    _worker_static = staticSim(**init_kwargs)
+
+
+def _static_film(film_args):
+    '''Returns the number of sentences and static dataframe of a given
+    film and word alignment file in a worker process.
+    '''
+    return static_film(_worker_static, *film_args)
+
+
 def static_sys(args, sent_pair_files, sent_wa_files):
     '''Stores the static MT or static human data with static cosine
     distance scores in a tsv using pandas and gensim for a list of
@@ -113,32 +485,42 @@ def static_sys(args, sent_pair_files, sent_wa_files):
     '''
     machine_translation = args.machine_translation
 
-    static = staticSim(en_model=args.source_emb, nl_model=args.target_emb)
-
-    static_dict = defaultdict(list)
-    for idx, film in enumerate(sent_pair_files):
-        wa_sent_pairs, sent_pairs = wa_to_pairs(film, sent_wa_files[idx])
-        for sent_idx, sent in enumerate(wa_sent_pairs):
-            for pair in sent:
-                static_distance, sw, tw, = static.word_emb_cos(*pair)
-
-                static_dict['film'].append(film.as_posix().split('/')[5].split('_')[0])
-                static_dict['genre'].append(film.as_posix().split('/')[4].lower())
-                static_dict['sent_idx'].append(sent_idx)
-                static_dict['src_sent'].append(' '.join(sent_pairs[sent_idx][0]))
-                static_dict['tgt_sent'].append(' '.join(sent_pairs[sent_idx][1]))
-                static_dict['src'].append(sw)
-                static_dict['tgt'].append(tw)
-                static_dict['static_cosine'].append(static_distance)
-                static_dict['type'].append('human')
-
-    df_static = pd.DataFrame.from_dict(static_dict)
-
     source_emb = args.source_emb.split('/')[-1].split('.')[-2]
     if machine_translation:
-        df_static.to_csv(f'{args.data_input}/{name_timestamp()}-{source_emb}-static_mt.tsv', sep='\t')
+        out_stem = f'{args.data_input}/{args.timestamp}-{source_emb}-static_mt'
     else:
-        df_static.to_csv(f'{args.data_input}/{name_timestamp()}-{source_emb}-static.tsv', sep='\t')
+        out_stem = f'{args.data_input}/{args.timestamp}-{source_emb}-static'
+    sink = get_sink(args.output_format, out_stem, args.output_compression)
+    checkpoint = open_checkpoint(args, out_stem, sink, STATIC_SETTINGS)
+    if checkpoint is False:
+        return
+
+    en_vocab, nl_vocab = None, None
+    if args.corpus_vocab:
+        en_vocab, nl_vocab = corpus_vocab(sent_pair_files, sent_wa_files)
+    store_dtype = args.store_dtype
+    if args.workers > 1 and store_dtype is None:
+        # Workers share the pages of a memory mapped store
+        store_dtype = 'float32'
+    static = staticSim(en_model=args.source_emb, nl_model=args.target_emb,
+                       store_dtype=store_dtype, en_vocab=en_vocab,
+                       nl_vocab=nl_vocab, vocab_dir=args.data_input,
+                       compression=args.store_compression)
+
+    finished = False
+    try:
+        for idx, (film, df_static, n_sents, done) in enumerate(
+            iter_static(static, sent_pair_files, sent_wa_files, checkpoint, args.workers)
+        ):
+            if checkpoint and not done:
+                checkpoint.add(film, 0, n_sents, df_static)
+            sink.write(df_static, idx)
+        finished = True
+    finally:
+        sink.close(finished)
+
+    if checkpoint:
+        checkpoint.cleanup()
 
 
 def context_sys(args, sent_pair_files, sent_wa_files):
@@ -149,20 +531,60 @@ def context_sys(args, sent_pair_files, sent_wa_files):
     '''
     machine_translation = args.machine_translation
 
-    cont_embedder = contextualSim()
-    context = SimRunner(cont_embedder)
-
-    bar = alive_it(sent_pair_files)
-    frames = [context(*context.file_loader(film, sent_wa_files[idx]), film) for idx, film in enumerate(bar)]
-    df_context = pd.concat(frames)
     if machine_translation:
-        df_context.to_csv(f'{args.data_input}/{name_timestamp()}-context_mt.tsv', sep='\t')
+        out_stem = f'{args.data_input}/{args.timestamp}-context_mt'
     else:
-        df_context.to_csv(f'{args.data_input}/{name_timestamp()}-context.tsv', sep='\t')
+        out_stem = f'{args.data_input}/{args.timestamp}-context'
+    sent_idxs = None
+    if args.gold_data is not None:
+        out_stem = f'{out_stem}_gold'
+        sent_pair_files, sent_wa_files, sent_idxs = gold_sent_idxs(args.gold_data,
+                                                                   sent_pair_files,
+                                                                   sent_wa_files,
+                                                                   args.data_input)
+    sink = get_sink(args.output_format, out_stem, args.output_compression)
+    checkpoint = open_checkpoint(args, out_stem, sink, CONTEXT_SETTINGS)
+    if checkpoint is False:
+        return
+
+    cont_embedder = contextualSim(layer_strat=args.layer_strat,
+                                  batch_size=args.batch_size,
+                                  subword_pool=args.subword_pool,
+                                  cache_dir=args.cache_dir,
+                                  cache_bytes=int(args.cache_gb * 1024 ** 3),
+                                  backend=args.backend,
+                                  onnx_dir=args.data_input if args.cache_dir is None else args.cache_dir)
+    pool_size = args.pool_size
+    if pool_size is None and args.checkpoint_size is not None:
+        pool_size = 16 * args.checkpoint_size
+    context = CorpusRunner(cont_embedder,
+                           max_tokens=args.max_tokens,
+                           max_sentences=args.batch_size,
+                           pool_size=pool_size,
+                           workers=args.workers,
+                           threads_per_worker=args.threads_per_worker)
+
+    finished = False
+    try:
+        for film_idx, df in context.iter_films(sent_pair_files, sent_wa_files,
+                                               progress=alive_it,
+                                               checkpoint=checkpoint or None,
+                                               chunk_size=args.checkpoint_size,
+                                               sent_idxs=sent_idxs):
+            sink.write(df, film_idx)
+        finished = True
+    finally:
+        if cont_embedder.cache is not None:
+            cont_embedder.cache.save()
+        sink.close(finished)
+
+    if checkpoint:
+        checkpoint.cleanup()
 
 
 def main():
     args = arg_parser()
+    args.timestamp = args.resume if args.resume is not None else name_timestamp()
     sent_pair_files, sent_wa_files = file_finder(args)
 
     if args.type == 'contextual' or args.type == 'all':
@@ -0,0 +1,230 @@
+from filelock import FileLock
+from hashlib import sha1
+from pathlib import Path
+import json
+import os
+import numpy as np
+
+
+class embeddingCache:
+    '''A class used to store contextual sentence embeddings on disk.
+
+    Every entry is addressed by a hash of the model name, the layer
+    strategy and the sentence text. The token level hidden states, the
+    pooled sentence vector and the (int32) word ids of an entry are
+    stored in one data file that is read through a memory map, while
+    only the offset, shapes and last use of every entry are kept in a
+    json index. Entries are evicted least recently used first once the
+    data file grows past the size cap.
+
+    Several processes can share a cache directory. Entries are only
+    appended to the data file under a file lock, at the offset where
+    the file actually ends, and the index on disk is merged with that
+    of the object whenever it is saved. Evicting writes a compacted data
+    file of the next generation, so a data file is never truncated or
+    rewritten while another process may still read or append to it.
+    '''
+    def __init__(self, cache_dir, model_name, layer_strat,
+                 max_bytes=8 * 1024 ** 3, readonly=False, save_every=1000) -> None:
+        '''Initializes a cache object for a given cache directory,
+        model name and layer strategy, loading the existing index if
+        one exists. The index is saved (and the size cap enforced) every
+        save_every stored entries, or every eighth of the number of
+        entries if that is more, so saving the index stays linear in the
+        number of entries. A read-only cache (for example in worker
+        processes that share a cache) never changes the files on disk.
+        '''
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.cache_dir / 'index.json'
+        self.lock = FileLock(str(self.cache_dir / 'cache.lock'))
+        self.model_name = model_name
+        self.layer_strat = layer_strat
+        self.max_bytes = max_bytes
+        self.readonly = readonly
+        self.save_every = save_every
+
+        self.generation, self.counter, self.entries = self._read_index()
+        # The keys that were stored since the index was last saved
+        self.pending = set()
+        self._data = None
+
+    def __contains__(self, sent):
+        return self.key(sent) in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def data_path(self) -> Path:
+        '''Returns the path of the data file of the current generation.'''
+        return self.cache_dir / f'embeddings.{self.generation}.f32'
+
+    def key(self, sent:str, layer_strat:str=None) -> str:
+        '''Returns the content address of a given sentence for the
+        model and (given or default) layer strategy of the object.
+        '''
+        if layer_strat is None:
+            layer_strat = self.layer_strat
+        return sha1('\0'.join([self.model_name, layer_strat, sent]).encode('utf-8')).hexdigest()
+
+    def _read_index(self):
+        '''Returns the generation, use counter and entries of the index
+        on disk (an empty index if there is none).
+        '''
+        if not self.index_path.exists():
+            return 0, 0, {}
+        with open(self.index_path, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        return index['generation'], index['counter'], index['entries']
+
+    def _reload(self):
+        '''Replaces the entries of the object with the index on disk,
+        after another process compacted the data file.
+        '''
+        self.generation, counter, self.entries = self._read_index()
+        self.counter = max(self.counter, counter)
+        self.pending = set()
+        self._data = None
+
+    def _memmap(self, end:int):
+        '''Returns a memory map of the data file that covers at least
+        a given number of floats.
+        '''
+        if self._data is None or len(self._data) < end:
+            self._data = np.memmap(self.data_path, dtype=np.float32, mode='r',
+                                   shape=(os.path.getsize(self.data_path) // 4,))
+        return self._data
+
+    def get(self, sent:str, layer_strat:str=None):
+        '''Returns the token embeddings (tokens x hidden), the word id
+        per token (-1 for special tokens) and the sentence embedding for
+        a given sentence, or None if the sentence is not stored.
+        '''
+        key = self.key(sent, layer_strat)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        offset, n_tokens, dim, sent_dim, _ = entry
+        try:
+            data = self._memmap(offset + entry_size(entry))
+        except FileNotFoundError:
+            # Another process compacted the cache into a new data file
+            self._reload()
+            return self.get(sent, layer_strat) if key in self.entries else None
+
+        self.counter += 1
+        entry[4] = self.counter
+        sent_start = offset + n_tokens * dim
+        token_embeddings = data[offset:sent_start].reshape(n_tokens, dim)
+        sent_embedding = data[sent_start:sent_start + sent_dim]
+        word_ids = data[sent_start + sent_dim:sent_start + sent_dim + n_tokens].view(np.int32)
+        return token_embeddings, word_ids.astype(np.int64), sent_embedding
+
+    def put(self, sent:str, token_embeddings, word_ids, sent_embedding, layer_strat:str=None):
+        '''Stores the token embeddings, word ids and sentence embedding
+        of a given sentence.
+        '''
+        key = self.key(sent, layer_strat)
+        if self.readonly or key in self.entries:
+            return
+
+        token_embeddings = np.ascontiguousarray(token_embeddings, dtype=np.float32)
+        sent_embedding = np.ascontiguousarray(sent_embedding, dtype=np.float32)
+        n_tokens, dim = token_embeddings.shape
+
+        with self.lock:
+            if not self.data_path.exists():
+                # Another process may have compacted the cache into a new data file
+                self._reload()
+            with open(self.data_path, 'ab') as f:
+                end = f.seek(0, os.SEEK_END)
+                if end % 4:
+                    # An interrupted write left part of a float behind
+                    f.write(bytes(4 - end % 4))
+                    end += 4 - end % 4
+                f.write(token_embeddings.tobytes())
+                f.write(sent_embedding.tobytes())
+                f.write(np.asarray(word_ids, dtype=np.int32).tobytes())
+
+        self.counter += 1
+        self.entries[key] = [end // 4, n_tokens, dim, len(sent_embedding), self.counter]
+        self.pending.add(key)
+        if self.save_every and len(self.pending) >= max(self.save_every, len(self.entries) // 8):
+            self.save()
+
+    def evict(self):
+        '''Removes the least recently used entries until the data file
+        is under the size cap and compacts them into the data file of
+        the next generation. Has to be called with the lock held.
+        '''
+        if not self.data_path.exists() or os.path.getsize(self.data_path) <= self.max_bytes:
+            return
+
+        kept = {}
+        kept_size = 0
+        for key, entry in sorted(self.entries.items(), key=lambda x : x[1][4], reverse=True):
+            if (kept_size + entry_size(entry)) * 4 > self.max_bytes:
+                break
+            kept[key] = entry
+            kept_size += entry_size(entry)
+
+        data = self._memmap(max([entry[0] + entry_size(entry) for entry in kept.values()], default=0))
+        new_path = self.cache_dir / f'embeddings.{self.generation + 1}.f32'
+        tmp_path = new_path.with_suffix('.tmp')
+        new_end = 0
+        with open(tmp_path, 'wb') as f:
+            for key, entry in sorted(kept.items(), key=lambda x : x[1][0]):
+                f.write(np.asarray(data[entry[0]:entry[0] + entry_size(entry)]).tobytes())
+                entry[0] = new_end
+                new_end += entry_size(entry)
+
+        self._data = None
+        os.replace(tmp_path, new_path)
+        self.generation += 1
+        self.entries = kept
+
+    def save(self):
+        '''Merges the entries of the object into the index on disk,
+        evicts entries if the cache is over its size cap and writes the
+        index.
+        '''
+        if self.readonly:
+            return
+
+        with self.lock:
+            generation, counter, entries = self._read_index()
+            if generation == self.generation:
+                for key, entry in self.entries.items():
+                    if key not in entries and key in self.pending:
+                        entries[key] = entry
+                    elif key in entries:
+                        entries[key][4] = max(entries[key][4], entry[4])
+            else:
+                # The pending entries went to a data file that was compacted away
+                self._data = None
+            self.generation = generation
+            self.counter = max(self.counter, counter)
+            self.entries = entries
+            self.pending = set()
+
+            self.evict()
+            tmp_path = self.index_path.with_suffix('.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'generation': self.generation, 'counter': self.counter,
+                           'entries': self.entries}, f)
+            os.replace(tmp_path, self.index_path)
+
+            # Readers that still map an older data file keep their pages
+            for path in self.cache_dir.glob('embeddings.*.f32'):
+                if path != self.data_path:
+                    path.unlink()
+
+
+def entry_size(entry) -> int:
+    '''Returns the number of 4 byte values (token embeddings, sentence
+    embedding and word ids) of a given index entry in the data file.
+    '''
+    _, n_tokens, dim, sent_dim, _ = entry
+    return n_tokens * dim + sent_dim + n_tokens
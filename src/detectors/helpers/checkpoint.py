@@ -0,0 +1,92 @@
+from pathlib import Path
+import json
+import os
+import shutil
+import pandas as pd
+
+
+class runCheckpoint:
+    '''A class used to checkpoint a detector run in sentence chunks.
+
+    Every finished chunk (a range of sentence indices of a film) is
+    stored as a pickled frame in a checkpoint folder next to the output,
+    and a manifest in that folder records the finished (film, sent_idx)
+    ranges. A resumed run with the same configuration skips the
+    finished chunks. Films are recorded by their path relative to the
+    data root, so a run can be resumed from another working directory.
+    '''
+    def __init__(self, out_stem, config:dict, resume=False, data_root='.') -> None:
+        '''Initializes the checkpoint for a given output path stem, run
+        configuration and data root. If resume is true, the existing
+        manifest is loaded and its configuration has to match the given
+        one.
+        '''
+        self.ckpt_dir = Path(f'{out_stem}.ckpt')
+        self.manifest_path = self.ckpt_dir / 'manifest.json'
+        self.data_root = Path(data_root).resolve()
+        self.config = config
+        self.chunks = {}
+
+        if resume:
+            if not self.manifest_path.exists():
+                raise FileNotFoundError(f'No checkpoint to resume at {self.ckpt_dir}')
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            changed = [key for key in set(manifest['config']) | set(config)
+                       if manifest['config'].get(key) != config.get(key)]
+            if changed:
+                raise ValueError(f'The checkpoint was made with different settings: {changed}')
+            self.chunks = manifest['chunks']
+        else:
+            self.ckpt_dir.mkdir(parents=True, exist_ok=True)
+            self._write_manifest()
+
+    def _write_manifest(self):
+        '''Writes the manifest to disk (atomically).'''
+        tmp_path = self.manifest_path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'config': self.config, 'chunks': self.chunks}, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _film_key(self, film) -> str:
+        '''Returns the manifest key of a given film, its path relative
+        to the data root.
+        '''
+        film = Path(film).resolve()
+        try:
+            return film.relative_to(self.data_root).as_posix()
+        except ValueError:
+            return film.as_posix()
+
+    def _chunk_path(self, film, start):
+        '''Returns the path of the stored frame of a chunk.'''
+        film_key = self._film_key(film).strip('./').replace('/', '__')
+        return self.ckpt_dir / f'{film_key}__{start}.pkl'
+
+    def is_done(self, film, start:int, end:int) -> bool:
+        '''Returns whether the sentences start to end (exclusive) of a
+        given film have been finished.
+        '''
+        return [start, end] in self.chunks.get(self._film_key(film), [])
+
+    def add(self, film, start:int, end:int, df:pd.DataFrame):
+        '''Stores the frame of a finished chunk and records it in the
+        manifest.
+        '''
+        df.to_pickle(self._chunk_path(film, start))
+        self.chunks.setdefault(self._film_key(film), []).append([start, end])
+        self._write_manifest()
+
+    def film_frame(self, film) -> pd.DataFrame:
+        '''Returns the frame of all finished chunks of a given film in
+        sentence order.
+        '''
+        frames = [pd.read_pickle(self._chunk_path(film, start))
+                  for start, _ in sorted(self.chunks.get(self._film_key(film), []))]
+        if not frames:
+            return pd.DataFrame()
+        return pd.concat(frames, ignore_index=True)
+
+    def cleanup(self):
+        '''Removes the checkpoint folder after a finished run.'''
+        shutil.rmtree(self.ckpt_dir, ignore_errors=True)
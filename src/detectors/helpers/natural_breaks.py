@@ -0,0 +1,238 @@
+from statistics import mean
+import numpy as np
+import pandas as pd
+import jenkspy
+
+
+# Splits that are this close to the best split (in summed squared
+# deviations) are resolved by jenkspy itself, so that floating point
+# ties are broken in the same way
+TIE_TOLERANCE = 1e-9
+# Major group means that are this close to a threshold are recomputed
+# exactly (as statistics.mean does) before they are compared
+MEAN_TOLERANCE = 1e-9
+
+
+class sentenceGroups:
+    '''A class used to split the word scores of many sentences into a
+    lower and a higher group with two class natural breaks (Jenks) at
+    once.
+
+    For two classes the optimal break of a sentence is the split of its
+    sorted scores with the lowest summed squared deviations, which is
+    found for all sentences of the same length at once from prefix sums
+    of the sorted scores. The groups, the major group and its mean are
+    identical to running jenkspy.jenks_breaks per sentence.
+    '''
+    def __init__(self, scores, sent_codes=None, cosine_sent=None) -> None:
+        '''Initializes the groups for given word scores, a sentence
+        code per word (such as the sentence index; all words are one
+        sentence if not given) and optionally the sentence score per
+        word. The words of a sentence do not have to be adjacent.
+        '''
+        self.scores = np.asarray(scores, dtype=np.float64)
+        n_rows = len(self.scores)
+        if sent_codes is None:
+            sent_codes = np.zeros(n_rows, dtype=np.int64)
+        sent_codes = np.asarray(sent_codes)
+
+        # Sort by sentence and score, the sort is stable so the words of
+        # a sentence keep their row order between equal scores
+        self.order = np.lexsort((self.scores, sent_codes))
+        sorted_codes = sent_codes[self.order]
+        sorted_scores = self.scores[self.order]
+        is_start = np.ones(n_rows, dtype=bool)
+        is_start[1:] = sorted_codes[1:] != sorted_codes[:-1]
+        self.starts = np.flatnonzero(is_start)
+        self.ends = np.append(self.starts[1:], n_rows)
+        self.counts = self.ends - self.starts
+        self.n_sents = len(self.starts)
+        self.sent_codes = sorted_codes[self.starts]
+
+        # Sentence number of every row in the original row order
+        self.row_sent = np.empty(n_rows, dtype=np.int64)
+        self.row_sent[self.order] = np.cumsum(is_start) - 1
+        # The first row of every sentence in the original row order
+        self.first_row = (np.minimum.reduceat(self.order, self.starts)
+                          if n_rows else np.zeros(0, dtype=np.int64))
+
+        self.cosine_sent = None
+        if cosine_sent is not None:
+            self.cosine_sent = np.asarray(cosine_sent, dtype=np.float64)[self.first_row]
+
+        self._find_breaks(sorted_scores)
+        self._find_major_groups()
+
+    def _find_breaks(self, sorted_scores):
+        '''Finds the break (the highest score of the lower group) of
+        every sentence, and which sentences have a single unique score
+        or could not be split (non-finite scores).
+        '''
+        n_sents = self.n_sents
+        self.breaks = np.zeros(n_sents, dtype=np.float64)
+        self.single = np.zeros(n_sents, dtype=bool)
+        self.failed = np.zeros(n_sents, dtype=bool)
+        if n_sents == 0:
+            return
+
+        low = sorted_scores[self.starts]
+        high = sorted_scores[self.ends - 1]
+        finite = np.logical_and.reduceat(np.isfinite(sorted_scores), self.starts)
+        self.single = (self.counts == 1) | (low == high)
+        self.failed = ~self.single & ~finite
+        self.breaks[self.single] = high[self.single]
+
+        split = ~self.single & ~self.failed
+        for length in np.unique(self.counts[split]):
+            sents = np.flatnonzero(split & (self.counts == length))
+            values = sorted_scores[self.starts[sents][:, None] + np.arange(length)]
+
+            # The lower group holds the first s scores, for s = 1 to length - 1
+            low_sum = np.cumsum(values, axis=1)[:, :-1]
+            low_sq = np.cumsum(values * values, axis=1)[:, :-1]
+            high_sum = np.cumsum(values[:, ::-1], axis=1)[:, ::-1][:, 1:]
+            high_sq = np.cumsum((values * values)[:, ::-1], axis=1)[:, ::-1][:, 1:]
+            n_low = np.arange(1, length)
+            deviations = (low_sq - low_sum * low_sum / n_low) \
+                         + (high_sq - high_sum * high_sum / (length - n_low))
+
+            best = np.argmin(deviations, axis=1)
+            self.breaks[sents] = values[np.arange(len(sents)), best]
+
+            near_ties = ((deviations - deviations.min(axis=1, keepdims=True))
+                         <= TIE_TOLERANCE).sum(axis=1) > 1
+            for sent in sents[near_ties]:
+                self.breaks[sent] = jenkspy.jenks_breaks(self.sent_scores(sent), n_classes=2)[1]
+
+    def _find_major_groups(self):
+        '''Finds the group of every word, and the major group (the most
+        common group, or the group of the first word on a tie) and its
+        mean score for every sentence.
+        '''
+        self.higher = self.scores > self.breaks[self.row_sent]
+        n_higher = np.bincount(self.row_sent, weights=self.higher, minlength=self.n_sents)
+        n_lower = self.counts - n_higher
+        self.major_higher = np.where(n_higher == n_lower,
+                                     self.higher[self.first_row],
+                                     n_higher > n_lower)
+
+        in_major = self.higher == self.major_higher[self.row_sent]
+        major_sum = np.bincount(self.row_sent, weights=np.where(in_major, self.scores, 0),
+                                minlength=self.n_sents)
+        major_count = np.where(self.major_higher, n_higher, n_lower)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.major_mean = major_sum / major_count
+        # Every word of a sentence with a single score is in the major group
+        self.major_mean[self.single] = self.breaks[self.single]
+        self.major_higher[self.single] = False
+
+    def sent_scores(self, sent:int) -> list:
+        '''Returns the word scores of a given sentence number in row order.'''
+        rows = np.sort(self.order[self.starts[sent]:self.ends[sent]])
+        return self.scores[rows].tolist()
+
+    def exact_major_mean(self, sent:int) -> float:
+        '''Returns the major group mean of a given sentence number
+        computed exactly with statistics.mean.
+        '''
+        if self.single[sent]:
+            return self.breaks[sent]
+        rows = np.sort(self.order[self.starts[sent]:self.ends[sent]])
+        return mean(self.scores[rows][self.higher[rows] == self.major_higher[sent]].tolist())
+
+    def major_shifts(self, thresholds, sent_sim=False):
+        '''Returns a boolean array (thresholds x sentences) with whether
+        the major group of every sentence is labeled as a creative shift
+        for every given threshold: whether the major group mean, or the
+        sentence score if sent_sim is true, is above the threshold (a
+        sentence with a single word score always uses that score).
+        '''
+        thresholds = np.asarray(thresholds, dtype=np.float64)[:, None]
+        if sent_sim:
+            return np.where(self.single, self.major_mean, self.cosine_sent) > thresholds
+
+        major_shifts = self.major_mean > thresholds
+        for t_idx, sent in zip(*np.nonzero(np.abs(self.major_mean - thresholds) <= MEAN_TOLERANCE)):
+            major_shifts[t_idx, sent] = self.exact_major_mean(sent) > thresholds[t_idx, 0]
+        return major_shifts
+
+    def shift_table(self, thresholds, sent_sim=False, simple_thres=False):
+        '''Returns a boolean array (thresholds x words, in row order)
+        with whether every word is labeled as a creative shift for every
+        given threshold.
+
+        If simple_thres is true, every word score is compared to the
+        threshold. Otherwise the major group is labeled by comparing its
+        mean (or the sentence score if sent_sim is true) to the
+        threshold, and the minor group is labeled as a reproduction if
+        the major group is the higher group and as a creative shift if
+        it is the lower group.
+        '''
+        if simple_thres:
+            return self.scores > np.asarray(thresholds, dtype=np.float64)[:, None]
+
+        major_shifts = self.major_shifts(thresholds, sent_sim=sent_sim)[:, self.row_sent]
+        minor_shifts = ~self.major_higher[self.row_sent]
+        in_major = (self.higher == self.major_higher[self.row_sent]) | self.single[self.row_sent]
+        return np.where(in_major, major_shifts, minor_shifts)
+
+    def shift_keys(self, rows, sent_sim=False, simple_thres=False):
+        '''Returns the score that decides the label of each of the given
+        words (row numbers) for any threshold, a word is labeled as a
+        creative shift if its key is above the threshold (see
+        shift_table for the options). Words of a minor group have a NaN
+        key and a label that does not depend on the threshold, which is
+        returned as a second boolean array.
+        '''
+        rows = np.asarray(rows, dtype=np.int64)
+        if simple_thres:
+            return self.scores[rows], np.zeros(len(rows), dtype=bool)
+
+        sents = self.row_sent[rows]
+        if sent_sim:
+            major_scores = np.where(self.single, self.major_mean, self.cosine_sent)
+        else:
+            major_scores = self.major_mean.copy()
+            for sent in np.unique(sents):
+                major_scores[sent] = self.exact_major_mean(sent)
+
+        in_major = (self.higher[rows] == self.major_higher[sents]) | self.single[sents]
+        keys = np.where(in_major, major_scores[sents], np.nan)
+        return keys, ~in_major & ~self.major_higher[sents]
+
+    def shifts(self, threshold:float, sent_sim=False, simple_thres=False):
+        '''Returns a boolean array with whether every word (in row
+        order) is labeled as a creative shift for a given threshold,
+        see shift_table for the options.
+        '''
+        return self.shift_table([threshold], sent_sim=sent_sim, simple_thres=simple_thres)[0]
+
+    def labels(self, threshold:float, sent_sim=False, simple_thres=False) -> list:
+        '''Returns a list with the label of every word (in row order)
+        for a given threshold, see shift_table for the options.
+        '''
+        shifts = self.shifts(threshold, sent_sim=sent_sim, simple_thres=simple_thres)
+        return np.where(shifts, 'creative shift', 'reproduction').tolist()
+
+    def groups(self) -> list:
+        '''Returns a list with the group (lower or higher) of every
+        word in row order, every word of a sentence with a single score
+        is in the lower group.
+        '''
+        return np.where(self.higher, 'higher', 'lower').tolist()
+
+    def table(self) -> pd.DataFrame:
+        '''Returns a dataframe with the threshold independent statistics
+        of every sentence: its code, number of words, break, major group
+        and major group mean, whether it has a single score, and its
+        sentence score (if given).
+        '''
+        return pd.DataFrame({
+            'sent_code': self.sent_codes,
+            'n_words': self.counts,
+            'break': self.breaks,
+            'major_group': np.where(self.major_higher, 'higher', 'lower'),
+            'major_mean': self.major_mean,
+            'single': self.single,
+            'cosine_sent': self.cosine_sent,
+        })
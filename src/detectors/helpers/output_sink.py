@@ -0,0 +1,121 @@
+from pathlib import Path, PurePath
+import os
+import pandas as pd
+
+
+class tsvSink:
+    '''A class used to store detector output in a single tsv.
+
+    Frames are collected in memory and written in film order when the
+    sink is closed, which matches the original behaviour of the detector.
+    '''
+    extension = 'tsv'
+
+    def __init__(self, path, compression=None) -> None:
+        '''Initializes the sink for a given output path.'''
+        self.path = path
+        self.frames = []
+
+    def is_finished(self) -> bool:
+        '''Returns whether the output was already finished.'''
+        return Path(self.path).exists()
+
+    def write(self, df:pd.DataFrame, film_idx:int=None):
+        '''Adds the frame of a finished film (with its index in the
+        list of films) to the output.
+        '''
+        if film_idx is None:
+            film_idx = len(self.frames)
+        self.frames.append((film_idx, df))
+
+    def close(self, finished=True):
+        '''Writes all collected frames to the tsv if the run has
+        finished, an interrupted run leaves no (partial) tsv.
+        '''
+        if finished and self.frames:
+            frames = [df for _, df in sorted(self.frames, key=lambda x : x[0])]
+            pd.concat(frames).to_csv(self.path, sep='\t')
+
+
+class parquetSink:
+    '''A class used to stream detector output into a Parquet dataset.
+
+    The output is a folder with a Parquet file per film, named after
+    the index of the film, which is written as soon as the film is
+    finished. A film that was written is complete even if the run
+    crashes later, the part files are read back (in film order) as one
+    table by pyarrow.parquet.read_table, and readers can skip films
+    through the statistics and only read the columns they need. A
+    _SUCCESS file marks a finished run.
+    '''
+    extension = 'parquet'
+
+    def __init__(self, path, compression=None) -> None:
+        '''Initializes the sink for a given output folder and an
+        optional compression codec (such as zstd).
+        '''
+        import pyarrow  # noqa: F401 (fail early if pyarrow is missing)
+
+        self.path = path
+        self.compression = 'none' if compression is None else compression
+        self.schema = None
+        self.n_written = 0
+
+    def is_finished(self) -> bool:
+        '''Returns whether the output was already finished.'''
+        return (Path(self.path) / '_SUCCESS').exists()
+
+    def _to_table(self, df:pd.DataFrame):
+        '''Returns a pyarrow table for a given frame, storing paths
+        (such as the film column of contextual output) as strings.
+        '''
+        import pyarrow as pa
+
+        df = df.copy()
+        for col in df.columns:
+            if df[col].dtype == object and len(df) and isinstance(df[col].iloc[0], PurePath):
+                df[col] = df[col].map(lambda x : x.as_posix())
+
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if self.schema is None:
+            self.schema = table.schema
+        return table.cast(self.schema)
+
+    def write(self, df:pd.DataFrame, film_idx:int=None):
+        '''Writes the frame of a finished film (with its index in the
+        list of films) as its own part file.
+        '''
+        import pyarrow.parquet as pq
+
+        if film_idx is None:
+            film_idx = self.n_written
+        self.n_written += 1
+        if df.empty:
+            return
+
+        Path(self.path).mkdir(parents=True, exist_ok=True)
+        part_path = Path(self.path) / f'part-{film_idx:06d}.parquet'
+        # Hidden files are skipped by readers, so a part only shows up once complete
+        tmp_path = part_path.with_name(f'.{part_path.name}.tmp')
+        pq.write_table(self._to_table(df), tmp_path, compression=self.compression)
+        os.replace(tmp_path, part_path)
+
+    def close(self, finished=True):
+        '''Marks the output as finished if the run has finished.'''
+        if finished:
+            Path(self.path).mkdir(parents=True, exist_ok=True)
+            (Path(self.path) / '_SUCCESS').touch()
+
+
+SINKS = {
+    'tsv': tsvSink,
+    'parquet': parquetSink,
+}
+
+
+def get_sink(out_format:str, path_stem:str, compression:str=None):
+    '''Returns an output sink for a given output format (tsv or parquet)
+    which writes to the given path stem with the matching extension.
+    '''
+    sink = SINKS[out_format]
+    return sink(f'{path_stem}.{sink.extension}', compression=compression)
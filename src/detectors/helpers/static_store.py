@@ -0,0 +1,295 @@
+from hashlib import sha1
+from pathlib import Path
+import json
+import os
+import numpy as np
+
+
+class staticStore:
+    '''A class used to read static word embeddings from a binary store.
+
+    A store consists of a vocabulary file (one word per line, the line
+    number is the row of the word) and a float32 or float16 .npy matrix
+    next to the original embedding file. The matrix is opened as a read
+    only memory map, so loading takes seconds and its pages are shared
+    by every process on the host that opens the same store. The class
+    offers the parts of the Gensim KeyedVectors interface that staticSim
+    uses.
+
+    A compressed store (see compress_store) holds PCA reduced and/or
+    int8 quantized vectors, int8 rows come with a scale factor per row.
+    Cosines can be computed on the stored vectors directly, as the
+    scale of a row does not change its direction.
+    '''
+    def __init__(self, emb_path, dtype='float32') -> None:
+        '''Initializes a store object for a given (text) embedding path
+        or corpus store path and matrix dtype, the store has to be
+        converted first (see convert_word2vec and corpus_store).
+        '''
+        self.vocab_path, self.matrix_path = store_paths(emb_path, dtype)
+        self.vectors = np.load(self.matrix_path, mmap_mode='r')
+        self.scales = None
+        if scale_path(emb_path, dtype).exists():
+            self.scales = np.load(scale_path(emb_path, dtype), mmap_mode='r')
+        with open(self.vocab_path, 'r', encoding='utf-8', newline='\n') as f:
+            self.index_to_key = f.read().split('\n')[:len(self.vectors)]
+        self.key_to_index = {word: idx for idx, word in enumerate(self.index_to_key)}
+
+    def __contains__(self, word):
+        return word in self.key_to_index
+
+    def __len__(self):
+        return len(self.index_to_key)
+
+    def get_index(self, word) -> int:
+        '''Returns the row of a given word.'''
+        return self.key_to_index[word]
+
+    def get_vector(self, word):
+        '''Returns the float32 vector of a given word.'''
+        idx = self.key_to_index[word]
+        vector = np.asarray(self.vectors[idx], dtype=np.float32)
+        if self.scales is not None:
+            vector = vector * self.scales[idx]
+        return vector
+
+    def nbytes(self) -> int:
+        '''Returns the size of the vectors (and scales) in bytes.'''
+        return self.vectors.nbytes + (0 if self.scales is None else self.scales.nbytes)
+
+
+def store_paths(emb_path, dtype='float32'):
+    '''Returns the vocabulary path and matrix path of the store of a
+    given embedding path and matrix dtype.
+    '''
+    emb_path = Path(emb_path)
+    return (emb_path.with_name(f'{emb_path.name}.vocab'),
+            emb_path.with_name(f'{emb_path.name}.{dtype}.npy'))
+
+
+def scale_path(emb_path, dtype):
+    '''Returns the path of the row scales of an int8 store of a given
+    embedding path and store dtype.
+    '''
+    emb_path = Path(emb_path)
+    return emb_path.with_name(f'{emb_path.name}.{dtype}.scale.npy')
+
+
+def source_path(emb_path, dtype):
+    '''Returns the path of the file that records which version of a
+    given embedding path the store of a given dtype was made from.
+    '''
+    emb_path = Path(emb_path)
+    return emb_path.with_name(f'{emb_path.name}.{dtype}.source.json')
+
+
+def source_stat(emb_path) -> dict:
+    '''Returns the resolved path, size and modification time of a
+    given embedding file, which identify the version of the file.
+    '''
+    emb_path = Path(emb_path).resolve()
+    stat = emb_path.stat()
+    return {'path': emb_path.as_posix(), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def write_source(emb_path, dtype):
+    '''Records the version of a given embedding path that its store of
+    a given dtype was made from, once the store is complete.
+    '''
+    with open(source_path(emb_path, dtype), 'w', encoding='utf-8') as f:
+        json.dump(source_stat(emb_path), f)
+
+
+def store_exists(emb_path, dtype='float32') -> bool:
+    '''Returns whether a given embedding path has a store of a given
+    matrix dtype that was made from the current version of the
+    embedding file, so a regenerated (or replaced) embedding file is
+    converted again. A store without its embedding file (such as a
+    corpus store) is always used.
+    '''
+    if not all(path.exists() for path in store_paths(emb_path, dtype)):
+        return False
+    if not Path(emb_path).exists():
+        return True
+    if not source_path(emb_path, dtype).exists():
+        return False
+    with open(source_path(emb_path, dtype), 'r', encoding='utf-8') as f:
+        return json.load(f) == source_stat(emb_path)
+
+
+def convert_word2vec(emb_path, dtype='float32', words=None, out_path=None):
+    '''Converts a given embedding file in the word2vec text format (a
+    header with the number of words and dimensions, then a word and its
+    vector per line) to a store with a matrix of a given dtype. If a set
+    of words is given, only those words are kept, and the store is
+    written for out_path instead of the embedding path if one is given.
+
+    The file is read line by line into a memory mapped matrix, so the
+    full text file never has to be held in memory. A word that occurs
+    more than once keeps its first vector. The files are written
+    atomically, so an interrupted conversion never leaves a store.
+    '''
+    vocab_path, matrix_path = store_paths(emb_path if out_path is None else out_path, dtype)
+    tmp_matrix_path = matrix_path.with_name(f'{matrix_path.name}.tmp')
+    tmp_vocab_path = vocab_path.with_name(f'{vocab_path.name}.tmp')
+
+    kept = {}
+    with open(emb_path, 'r', encoding='utf-8') as f:
+        n_words, dim = [int(i) for i in f.readline().split()]
+        n_rows = n_words if words is None else min(n_words, len(words))
+        matrix = np.lib.format.open_memmap(tmp_matrix_path, mode='w+',
+                                           dtype=dtype, shape=(n_rows, dim))
+        for line_idx, line in enumerate(f):
+            word, _, vector = line.rstrip().partition(' ')
+            if word in kept or (words is not None and word not in words):
+                continue
+            vector = vector.split(' ')
+            if len(vector) != dim:
+                raise ValueError(f'Invalid vector on line {line_idx + 2} of {emb_path}')
+            kept[word] = len(kept)
+            matrix[len(kept) - 1] = np.array(vector, dtype=np.float32)
+
+    if len(kept) < n_rows:
+        # Duplicate (or missing) words leave unused rows at the end of the matrix
+        full_matrix = matrix
+        matrix = np.lib.format.open_memmap(tmp_matrix_path.with_name(f'{tmp_matrix_path.name}2'),
+                                           mode='w+', dtype=dtype, shape=(len(kept), dim))
+        matrix[:] = full_matrix[:len(kept)]
+        del full_matrix
+        os.replace(matrix.filename, tmp_matrix_path)
+    matrix.flush()
+    del matrix
+
+    write_vocab(tmp_vocab_path, kept)
+    os.replace(tmp_matrix_path, matrix_path)
+    os.replace(tmp_vocab_path, vocab_path)
+    if out_path is None:
+        write_source(emb_path, dtype)
+
+
+def write_vocab(path, words):
+    '''Writes a given list of words as a vocabulary file.'''
+    with open(path, 'w', encoding='utf-8', newline='\n') as f:
+        f.write('\n'.join(words))
+
+
+def corpus_store(emb_path, words, out_dir, dtype='float32'):
+    '''Returns the path of a store in a given output folder with only
+    the vectors of a given set of words (such as every word of a corpus)
+    from a given embedding path, which is made once per set of words.
+
+    The store is addressed by a hash of the resolved embedding path,
+    the size and modification time of the embedding file (or of its
+    full store if only that is kept) and the words, so another embedding
+    with the same file name, a regenerated embedding file or another
+    corpus gets its own store. It is copied from the full store of the
+    embedding path if that exists, otherwise only the given words are
+    read from the text file.
+    '''
+    words = set(words)
+    emb_name = Path(emb_path).name
+    source = source_stat(emb_path if Path(emb_path).exists() else store_paths(emb_path, dtype)[1])
+    key = sha1('\0'.join([source['path'], str(source['size']), str(source['mtime_ns'])]
+                         + sorted(words)).encode('utf-8')).hexdigest()[:12]
+    out_path = Path(out_dir) / f'{emb_name}.corpus_{key}'
+    if store_exists(out_path, dtype):
+        return out_path
+
+    if not store_exists(emb_path, dtype):
+        convert_word2vec(emb_path, dtype, words=words, out_path=out_path)
+        return out_path
+
+    full_store = staticStore(emb_path, dtype)
+    kept = sorted((full_store.get_index(word), word) for word in words if word in full_store)
+    vocab_path, matrix_path = store_paths(out_path, dtype)
+    tmp_matrix_path = matrix_path.with_name(f'{matrix_path.name}.tmp')
+    tmp_vocab_path = vocab_path.with_name(f'{vocab_path.name}.tmp')
+    rows = [idx for idx, _ in kept]
+    if full_store.scales is not None:
+        # The scales are written first, a store only exists once its matrix does
+        with open(scale_path(out_path, dtype), 'wb') as f:
+            np.save(f, full_store.scales[rows])
+    with open(tmp_matrix_path, 'wb') as f:
+        np.save(f, full_store.vectors[rows])
+    write_vocab(tmp_vocab_path, [word for _, word in kept])
+    os.replace(tmp_matrix_path, matrix_path)
+    os.replace(tmp_vocab_path, vocab_path)
+    return out_path
+
+
+def parse_compression(compression:str):
+    '''Returns the number of PCA dimensions (None if the vectors are
+    not reduced) and whether the vectors are quantized to int8 for a
+    given compression name: pca<dims>, int8 or pca<dims>-int8.
+    '''
+    dims, int8 = None, False
+    for part in compression.split('-'):
+        if part == 'int8' and not int8:
+            int8 = True
+        elif part.startswith('pca') and part[3:].isdigit() and dims is None:
+            dims = int(part[3:])
+        else:
+            raise ValueError(f'Unknown compression {compression}, use pca<dims>, int8 or pca<dims>-int8')
+    return dims, int8
+
+
+def compress_store(emb_paths, compression:str, dtype='float32',
+                   sample_size=200000, seed=0, chunk_size=65536) -> str:
+    '''Writes a compressed store for every given embedding path (such
+    as the English and Dutch embeddings) from its store of a given dtype
+    and returns the store dtype of the compressed stores, which is made
+    once per compression (see parse_compression).
+
+    PCA reduces all languages with the same projection, the leading
+    right singular vectors of a sample of at most sample_size rows of
+    all given stores. The vectors are not centered first, so that their
+    dot products (and cosines) are kept as well as possible. int8
+    quantization stores every row as integers from -127 to 127 and the
+    scale that turns them back into the (reduced) vector.
+    '''
+    dims, int8 = parse_compression(compression)
+    out_dtype = f'{dtype}-{compression}'
+    if all(store_exists(emb_path, out_dtype) for emb_path in emb_paths):
+        return out_dtype
+
+    stores = [staticStore(emb_path, dtype) for emb_path in emb_paths]
+    components = None
+    if dims is not None:
+        rng = np.random.default_rng(seed)
+        n_sample = sample_size // len(stores)
+        sample = np.concatenate([
+            np.asarray(store.vectors[np.sort(rng.choice(len(store), min(n_sample, len(store)),
+                                                        replace=False))], dtype=np.float64)
+            for store in stores
+        ])
+        components = np.linalg.svd(sample, full_matrices=False)[2][:dims].T
+
+    for emb_path, store in zip(emb_paths, stores):
+        _, matrix_path = store_paths(emb_path, out_dtype)
+        tmp_matrix_path = matrix_path.with_name(f'{matrix_path.name}.tmp')
+        n_dims = store.vectors.shape[1] if dims is None else dims
+        matrix = np.lib.format.open_memmap(tmp_matrix_path, mode='w+',
+                                           dtype=np.int8 if int8 else dtype,
+                                           shape=(len(store), n_dims))
+        scales = np.ones(len(store), dtype=np.float32)
+        for c_start in range(0, len(store), chunk_size):
+            vectors = np.asarray(store.vectors[c_start:c_start + chunk_size], dtype=np.float64)
+            if components is not None:
+                vectors = vectors @ components
+            if int8:
+                c_scales = np.abs(vectors).max(axis=1) / 127
+                c_scales[c_scales == 0] = 1
+                scales[c_start:c_start + chunk_size] = c_scales
+                vectors = np.round(vectors / c_scales[:, None])
+            matrix[c_start:c_start + chunk_size] = vectors
+        matrix.flush()
+        del matrix
+
+        if int8:
+            with open(scale_path(emb_path, out_dtype), 'wb') as f:
+                np.save(f, scales)
+        # The vocabulary is the same as that of the uncompressed store
+        os.replace(tmp_matrix_path, matrix_path)
+        write_source(emb_path, out_dtype)
+
+    return out_dtype
@@ -0,0 +1,152 @@
+import sys
+import numpy as np
+import pandas as pd
+from argparse import ArgumentParser
+from pathlib import Path
+from static_cosine_sim import staticSim
+from helpers.timestamp import name_timestamp
+
+# The threshold tester is imported from the repository root as src.helpers, so
+# it never shares the helpers name with the detector helpers in this folder
+sys.path.append(str(Path(__file__).resolve().parents[2]))
+from src.helpers.threshold_tester import StaticThres
+
+
+def arg_parser():
+    parser = ArgumentParser()
+
+    parser.add_argument(
+        '-se',
+        '--source_emb',
+        type=str,
+        default='../../data/_embeddings/fasttext/cc.en.300.mapped.emb',
+        help='Give a source embedding '
+             '(default: ../../data/_embeddings/fasttext/cc.en.300.mapped.emb)'
+    )
+
+    parser.add_argument(
+        '-te',
+        '--target_emb',
+        type=str,
+        default='../../data/_embeddings/fasttext/cc.nl.300.mapped.emb',
+        help='Give a target embedding '
+             '(default: ../../data/_embeddings/fasttext/cc.nl.300.mapped.emb)'
+    )
+
+    parser.add_argument(
+        '-sd',
+        '--store_dtype',
+        type=str,
+        choices=['float32', 'float16'],
+        default='float32',
+        help='The dtype of the full store that the compressed stores are '
+             'made from and compared to (default: float32)'
+    )
+
+    parser.add_argument(
+        '-sc',
+        '--store_compression',
+        type=str,
+        nargs='+',
+        default=['int8', 'pca100', 'pca100-int8'],
+        help='The compressions that are compared to the full store '
+             '(default: int8 pca100 pca100-int8)'
+    )
+
+    parser.add_argument(
+        '-g',
+        '--gold_data',
+        type=str,
+        default='../../data/2_new_run/static_gold.tsv',
+        help='Give the static gold data, the report only scores its word '
+             'pairs (default: ../../data/2_new_run/static_gold.tsv)'
+    )
+
+    parser.add_argument(
+        '-di',
+        '--data_input',
+        type=str,
+        default='../../data/2_new_run',
+        help='Give a data input, which is the root file for the report '
+             '(default: ../../data/2_new_run)'
+    )
+
+    args = parser.parse_args()
+    return args
+
+
+def gold_sweep(gold:pd.DataFrame, distances) -> pd.DataFrame:
+    '''Returns the threshold sweep of the StaticThres (see
+    StaticThres.sweep) for given static distances of the gold pairs.
+    '''
+    finder = StaticThres(gold_data=gold.drop(columns=['static_cosine', 'genre'],
+                                             errors='ignore').reset_index(drop=True))
+    finder(pd.DataFrame({'static_cosine': distances, 'genre': None}))
+    finder.sweep()
+    return finder.sweep_df
+
+
+def f1_at(sweep_df:pd.DataFrame, threshold:float) -> float:
+    '''Returns the f1-score of a given threshold in a given sweep, the
+    predictions of a threshold are those of the highest distinct
+    threshold at or below it.
+    '''
+    return sweep_df['f1-score'].iloc[np.searchsorted(sweep_df.index, threshold, side='right') - 1]
+
+
+def compression_report(compressed:staticSim, gold:pd.DataFrame, full_dist,
+                       full_sweep:pd.DataFrame) -> dict:
+    '''Returns the size, score drift and threshold f1-scores of a
+    compressed staticSim object against the full vectors on the gold
+    pairs.
+    '''
+    dist = compressed.pair_cos(gold.src.to_list(), gold.tgt.to_list())
+    found = ~np.isnan(full_dist) & ~np.isnan(dist)
+    full_found = pd.Series(full_dist[found])
+    comp_found = pd.Series(dist[found])
+
+    comp_sweep = gold_sweep(gold, dist)
+    full_best = full_sweep.index[full_sweep['f1-score'].to_numpy().argmax()]
+    comp_best = comp_sweep.index[comp_sweep['f1-score'].to_numpy().argmax()]
+    return {
+        'megabytes': (compressed.en_model.nbytes() + compressed.nl_model.nbytes()) / 1024 ** 2,
+        'spearman': full_found.corr(comp_found, method='spearman'),
+        'pearson': full_found.corr(comp_found),
+        'max_abs_diff': (full_found - comp_found).abs().max(),
+        'mean_abs_diff': (full_found - comp_found).abs().mean(),
+        'full best threshold': full_best,
+        'full best f1': f1_at(full_sweep, full_best),
+        'f1 at full best': f1_at(comp_sweep, full_best),
+        'best threshold': comp_best,
+        'best f1': f1_at(comp_sweep, comp_best),
+        'f1 change': f1_at(comp_sweep, comp_best) - f1_at(full_sweep, full_best),
+    }
+
+
+def main():
+    args = arg_parser()
+    gold = pd.read_csv(args.gold_data, sep='\t', index_col=0)
+
+    full = staticSim(en_model=args.source_emb, nl_model=args.target_emb,
+                     store_dtype=args.store_dtype)
+    full_dist = full.pair_cos(gold.src.to_list(), gold.tgt.to_list())
+    full_sweep = gold_sweep(gold, full_dist)
+
+    report = {}
+    for compression in args.store_compression:
+        compressed = staticSim(en_model=args.source_emb, nl_model=args.target_emb,
+                               store_dtype=args.store_dtype, compression=compression)
+        report[compression] = compression_report(compressed, gold, full_dist, full_sweep)
+    report = pd.DataFrame(report).T
+    report.insert(1, 'full megabytes', (full.en_model.nbytes() + full.nl_model.nbytes()) / 1024 ** 2)
+
+    print(f'Compressed static stores against {args.store_dtype} on {len(gold)} gold pairs')
+    print(report.T)
+
+    source_emb = args.source_emb.split('/')[-1].split('.')[-2]
+    report.to_csv(f'{args.data_input}/{name_timestamp()}-{source_emb}-static_compression.tsv',
+                  sep='\t')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,7 @@
 from gensim.models import KeyedVectors
+from helpers.static_store import staticStore, store_exists, convert_word2vec, corpus_store, compress_store
+import numpy as np
+import pandas as pd
 import scipy
 
 
@@ -6,19 +9,62 @@ class staticSim:
     '''A class used to load embeddings into Gensim for inference.'''
     def __init__(self, lang='en-nl',
                  en_model='../../data/_embeddings/fasttext/cc.en.300.mapped.vec',
-                 nl_model='../../data/_embeddings/fasttext/cc.nl.300.mapped.vec') -> None:
+                 nl_model='../../data/_embeddings/fasttext/cc.nl.300.mapped.vec',
+                 store_dtype=None, en_vocab=None, nl_vocab=None,
+                 vocab_dir=None, compression=None) -> None:
         '''Initializes a staticSim object based on a given lang attribute
         (input-output) and loads the models for faster inference.
+
+        If a store_dtype (float32 or float16) is given, the models are
+        read from a memory mapped store of that dtype next to the
+        embedding files, which is converted once if it does not exist.
+        If the English and Dutch words of the corpus are given, only
+        their vectors are loaded from a store in vocab_dir that is made
+        once per corpus (see corpus_store). A compression (such as
+        pca100-int8, see compress_store) loads compressed stores that are
+        made once from the stores of store_dtype (float32 if not given).
         '''
         self.lang = lang
-        self.model_loader(en_model, nl_model)
+        self.store_dtype = store_dtype
+        self.vocab_dir = vocab_dir
+        self.compression = compression
+        # The arguments of the object, so worker processes can load the same models
+        self.init_kwargs = dict(lang=lang, en_model=en_model, nl_model=nl_model,
+                                store_dtype=store_dtype, en_vocab=en_vocab,
+                                nl_vocab=nl_vocab, vocab_dir=vocab_dir,
+                                compression=compression)
+        self.model_loader(en_model, nl_model, en_vocab, nl_vocab)
+
+    def model_loader(self, en_model, nl_model, en_vocab=None, nl_vocab=None):
+        '''Loads the given English and Dutch models into Gensim (or
+        from their stores) for inference.
+        '''
+        if self.compression is not None:
+            dtype = 'float32' if self.store_dtype is None else self.store_dtype
+            for emb_path in [en_model, nl_model]:
+                if not store_exists(emb_path, dtype):
+                    print(f'Converting {emb_path} to a {dtype} store')
+                    convert_word2vec(emb_path, dtype)
+            self.store_dtype = compress_store([en_model, nl_model], self.compression, dtype)
+
+        self.en_model = self.load_model(en_model, en_vocab)
+        self.nl_model = self.load_model(nl_model, nl_vocab)
 
-    def model_loader(self, en_model, nl_model):
-        '''Loads the given English and Dutch models into Gensim for
-        inference.
+    def load_model(self, emb_path, vocab=None):
+        '''Returns the model of a given embedding path, restricted to
+        the given vocabulary if one is given.
         '''
-        self.en_model = KeyedVectors.load_word2vec_format(en_model)
-        self.nl_model = KeyedVectors.load_word2vec_format(nl_model)
+        if vocab is not None:
+            dtype = 'float32' if self.store_dtype is None else self.store_dtype
+            return staticStore(corpus_store(emb_path, vocab, self.vocab_dir, dtype), dtype)
+
+        if self.store_dtype is None:
+            return KeyedVectors.load_word2vec_format(emb_path)
+
+        if not store_exists(emb_path, self.store_dtype):
+            print(f'Converting {emb_path} to a {self.store_dtype} store')
+            convert_word2vec(emb_path, self.store_dtype)
+        return staticStore(emb_path, self.store_dtype)
 
     def get_sl_vector(self, word):
         '''Returns the source language vector for a given word.'''
@@ -47,3 +93,49 @@ class staticSim:
             distance = (float('nan'))
 
         return distance, src_w, tgt_w
+
+    def word_rows(self, model, words):
+        '''Returns the row of every given word in the vectors of a given
+        model, -1 for words that are not found.
+        '''
+        return np.array([model.key_to_index.get(word, -1) for word in words], dtype=np.int64)
+
+    def unit_vectors(self, model, rows):
+        '''Returns the float64 vectors of given rows of a given model
+        scaled to unit length, NaN for rows that are -1.
+        '''
+        vectors = np.full((len(rows), model.vectors.shape[1]), np.nan)
+        vectors[rows != -1] = model.vectors[rows[rows != -1]]
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return vectors / norms
+
+    def pair_cos(self, src_words, tgt_words, chunk_size=65536):
+        '''Returns an array with the cosine distance of every given
+        source word and target word pair, NaN if a word is not found.
+
+        The words are turned into index arrays and unit vectors once per
+        distinct word, every distinct (source, target) pair is scored
+        only once with a row-wise dot product (in chunks of chunk_size
+        pairs), and the distances are scattered back to all pairs.
+        '''
+        src_codes, src_uniq = pd.factorize(pd.Series(src_words, dtype=object))
+        tgt_codes, tgt_uniq = pd.factorize(pd.Series(tgt_words, dtype=object))
+        n_tgt = max(len(tgt_uniq), 1)
+        pair_codes, pair_uniq = pd.factorize(src_codes * n_tgt + tgt_codes)
+        pair_src, pair_tgt = pair_uniq // n_tgt, pair_uniq % n_tgt
+
+        src_rows = self.word_rows(self.en_model, src_uniq)
+        tgt_rows = self.word_rows(self.nl_model, tgt_uniq)
+        src_vectors = self.unit_vectors(self.en_model, src_rows)
+        tgt_vectors = self.unit_vectors(self.nl_model, tgt_rows)
+
+        distances = np.full(len(pair_uniq), np.nan)
+        found_pairs = np.flatnonzero((src_rows[pair_src] != -1) & (tgt_rows[pair_tgt] != -1))
+        for c_start in range(0, len(found_pairs), chunk_size):
+            c_pairs = found_pairs[c_start:c_start + chunk_size]
+            dots = np.einsum('ij,ij->i', src_vectors[pair_src[c_pairs]],
+                             tgt_vectors[pair_tgt[c_pairs]])
+            distances[c_pairs] = np.clip(1.0 - dots, 0.0, 2.0)
+
+        return distances[pair_codes]
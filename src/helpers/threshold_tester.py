@@ -1,11 +1,173 @@
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
 import jenkspy
-from statistics import mean
-from collections import Counter
-from helpers.timestamp import name_timestamp
+from .timestamp import name_timestamp
+try:
+    # Imported from src (such as in the notebooks)
+    from detectors.helpers.natural_breaks import sentenceGroups
+except ImportError:
+    # Imported as src.helpers by the scripts in src/detectors, which have already
+    # loaded the detector helpers under their own name
+    from helpers.natural_breaks import sentenceGroups
 from sklearn.metrics import classification_report as report
 
 
+def film_id(film:str) -> str:
+    '''Returns the short film id (such as ac01) for a given film,
+    which is either already a short id or a full contextual file path.
+    '''
+    if '/' in film:
+        return film.split('/')[5].split('_')[0]
+    return film
+
+
+def load_scores(path, columns=None, films=None) -> pd.DataFrame:
+    '''Returns a detector output frame for a given tsv or parquet path.
+
+    Only the given columns and films (short film ids such as ac01) are
+    read. For parquet output (a file or a folder of part files) the
+    film filter skips the data of other films, for tsv output the full
+    file has to be parsed first.
+    '''
+    path = str(path).rstrip('/')
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+
+        filters = None
+        if films is not None:
+            films = set(films)
+            all_films = pq.read_table(path, columns=['film']).column('film').unique().to_pylist()
+            filters = [('film', 'in', [i for i in all_films if film_id(i) in films])]
+        return pq.read_table(path, columns=columns, filters=filters).to_pandas()
+
+    usecols = None if columns is None else lambda x : x in columns
+    df = pd.read_csv(path, sep='\t', index_col=0 if columns is None else None, usecols=usecols)
+    if films is not None:
+        df = df[df.film.apply(film_id).isin(set(films))]
+    return df
+
+
+def macro_scores(tp, fp, fn, tn):
+    '''Returns the macro averaged precision, recall and f1-score (as
+    in classification_report) of the creative shift and reproduction
+    classes for given arrays of confusion counts of the creative shift
+    class.
+    '''
+    scores = []
+    # The creative shift class and the reproduction class
+    for tp_c, fp_c, fn_c in [(tp, fp, fn), (tn, fn, fp)]:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            precision = np.nan_to_num(tp_c / (tp_c + fp_c))
+            recall = np.nan_to_num(tp_c / (tp_c + fn_c))
+            f1 = np.nan_to_num(2 * precision * recall / (precision + recall))
+        # A class only counts if it is in the gold labels or predictions
+        present = (tp_c + fp_c + fn_c) > 0
+        scores.append((precision, recall, f1, present))
+
+    n_present = scores[0][3].astype(int) + scores[1][3]
+    return tuple((scores[0][i] * scores[0][3] + scores[1][i] * scores[1][3]) / n_present
+                 for i in range(3))
+
+
+def sweep_thresholds(keys, gold_shift, const_shift=None) -> pd.DataFrame:
+    '''Returns a dataframe with the macro averaged precision, recall,
+    f1-score and support (as in classification_report) for every
+    distinct threshold of a given array of scores, where a score above
+    the threshold is predicted as a creative shift.
+
+    gold_shift holds whether every gold label is a creative shift.
+    Words with a NaN score have a prediction that does not depend on the
+    threshold, which is given in const_shift. The scores are sorted
+    once and the confusion counts are updated from one threshold to the
+    next, so every distinct threshold (including one below all scores,
+    -inf) is tested in O(n log n).
+    '''
+    keys = np.asarray(keys, dtype=np.float64)
+    gold_shift = np.asarray(gold_shift, dtype=bool)
+    if const_shift is None:
+        const_shift = np.zeros(len(keys), dtype=bool)
+    const_shift = np.asarray(const_shift, dtype=bool)
+
+    const = np.isnan(keys)
+    tp_const = (const & const_shift & gold_shift).sum()
+    fp_const = (const & const_shift & ~gold_shift).sum()
+
+    order = np.argsort(keys[~const], kind='stable')
+    sorted_keys = keys[~const][order]
+    sorted_gold = gold_shift[~const][order]
+    thresholds = np.append(-np.inf, np.unique(sorted_keys))
+
+    # Scores above a threshold are the scores after its last position
+    n_below = np.searchsorted(sorted_keys, thresholds, side='right')
+    gold_below = np.append(0, np.cumsum(sorted_gold))[n_below]
+    tp = tp_const + sorted_gold.sum() - gold_below
+    fp = fp_const + (len(sorted_keys) - n_below) - (sorted_gold.sum() - gold_below)
+    fn = gold_shift.sum() - tp
+    tn = len(keys) - tp - fp - fn
+
+    precision, recall, f1 = macro_scores(tp, fp, fn, tn)
+    sweep_df = pd.DataFrame({'precision': precision, 'recall': recall, 'f1-score': f1},
+                            index=thresholds)
+    sweep_df['support'] = float(len(keys))
+    return sweep_df
+
+
+def film_shifts(film_args) -> np.ndarray:
+    '''Returns whether every word of a film is labeled as a creative
+    shift for a given tuple of the word scores, sentence indices and
+    sentence scores of the film, a threshold and the labeling options
+    (see sentenceGroups.shift_table), grouping every sentence on its own.
+    '''
+    scores, sent_idxs, cosine_sent, threshold, options = film_args
+    groups = sentenceGroups(scores, sent_idxs, cosine_sent)
+    if groups.failed.any() and not options.get('simple_thres', False):
+        raise ValueError(f'Could not find the natural breaks of sentences '
+                         f'{groups.sent_codes[groups.failed].tolist()}')
+    return groups.shifts(threshold, **options)
+
+
+def best_threshold(sweep_args) -> list:
+    '''Returns the best threshold and its precision, recall, f1-score
+    and support for a given tuple of the sweep_thresholds arguments
+    (the lowest threshold if several have the best f1-score).
+    '''
+    sweep_df = sweep_thresholds(*sweep_args)
+    best = sweep_df['f1-score'].to_numpy().argmax()
+    return [sweep_df.index[best]] + sweep_df.iloc[best][['precision', 'recall', 'f1-score', 'support']].tolist()
+
+
+def fold_shifts(fold_args):
+    '''Returns the threshold metric, best threshold and its f1-score
+    on the training rows of a fold, and the predictions of that
+    threshold for the held-out rows, for a given tuple of the sweep keys
+    and threshold independent predictions per metric, the gold shifts
+    and a boolean array of the training rows.
+    '''
+    metric_keys, gold_shift, train = fold_args
+    best = None
+    for t_metric, (keys, const_shift) in metric_keys.items():
+        threshold, _, _, f1, _ = best_threshold((keys[train], gold_shift[train], const_shift[train]))
+        if best is None or f1 > best[2]:
+            best = (t_metric, threshold, f1)
+
+    keys, const_shift = metric_keys[best[0]]
+    with np.errstate(invalid='ignore'):
+        shifts = np.where(np.isnan(keys[~train]), const_shift[~train], keys[~train] > best[1])
+    return best, shifts
+
+
+def shift_scores(shifts, gold_shift) -> list:
+    '''Returns the macro averaged precision, recall, f1-score and
+    support of given predicted and gold shifts.
+    '''
+    tp = (shifts & gold_shift).sum()
+    fp = (shifts & ~gold_shift).sum()
+    fn = (~shifts & gold_shift).sum()
+    tn = (~shifts & ~gold_shift).sum()
+    return [float(i) for i in macro_scores(tp, fp, fn, tn)] + [float(len(shifts))]
+
+
 class ThresholdFinder:
     def __init__(self, thresholds=[.4, .45, .5, .55, .6],
                  gold_data='../../data/new_gold_v2_annotated.tsv', gold_sep='\t',
@@ -18,62 +180,87 @@ class ThresholdFinder:
         self.run_sent_sim = sent_sim
         self.human_label = human_label
 
-    def __call__(self, df:pd.DataFrame):
+    def __call__(self, df:pd.DataFrame|str, columns=None, films=None):
+        if not isinstance(df, pd.DataFrame):
+            df = load_scores(df, columns=columns, films=films)
         self.thres_dfs = {}
         df['file'] = df.film
         df['genre'] = df.film.apply(lambda x : x.split('/')[4])
         df['film'] = df.film.apply(lambda x : x.split('/')[5].split('_')[0])
         self.orig_df = df
 
-        for t in self.thresholds:
+        # The groups of every gold sentence do not depend on the threshold,
+        # so they are found once and every threshold only compares scores.
+        # The gold sentences are joined to the scores on (film, sent_idx)
+        gold_keys = pd.DataFrame({'film': self.gold.film.to_numpy(),
+                                  'sent_idx': self.gold.sent_idx.to_numpy(),
+                                  'gold_pos': np.arange(len(self.gold))})
+        df_keys = pd.DataFrame({'film': df.film.to_numpy(),
+                                'sent_idx': df.sent_idx.to_numpy(),
+                                'df_pos': np.arange(len(df))})
+        joined = gold_keys.merge(df_keys, how='inner', on=['film', 'sent_idx'])
+        joined = joined.iloc[np.lexsort((joined.df_pos, joined.gold_pos))]
+        self.gold_pos = joined.gold_pos.to_numpy()
+        self.gold_df = df.iloc[joined.df_pos.to_numpy()]
+        self.groups = sentenceGroups(self.gold_df.cosine_w, self.gold_pos, self.gold_df.cosine_sent)
+        if self.groups.failed.any():
+            raise ValueError(f'Could not find the natural breaks of gold sentences '
+                             f'{self.groups.sent_codes[self.groups.failed].tolist()}')
+        self.sent_table = self.groups.table()
+        self.sent_table.insert(1, 'film', self.gold.film.to_numpy()[self.groups.sent_codes])
+        self.sent_table.insert(2, 'sent_idx', self.gold.sent_idx.to_numpy()[self.groups.sent_codes])
+
+        t_metrics = self.threshold_metrics()
+        # The metrics of a gold sentence follow each other
+        order = np.argsort(np.tile(self.gold_pos, len(t_metrics)), kind='stable')
+
+        shift_tables = {t_metric: self.groups.shift_table(self.thresholds, **options)
+                        for t_metric, options in t_metrics.items()}
+        for t_idx, t in enumerate(self.thresholds):
             self.cur_thres = t
-
-            for idx, row in self.gold.iterrows():
-                if idx == 0:
-                    out_df = self.find_groups(df[(df.film == row.film) & (df.sent_idx == row.sent_idx)].copy())
-                    out_df['thres_metric'] = 'word-major-minor'
-                    self.thres_dfs[t] = out_df
-                else:
-                    out_df = self.find_groups(df[(df.film == row.film) & (df.sent_idx == row.sent_idx)].copy())
-                    out_df['thres_metric'] = 'word-major-minor'
-                    self.thres_dfs[t] = pd.concat([self.thres_dfs[t], out_df])
-
-                if self.run_sent_sim:
-                    out_df = self.find_groups(df[(df.film == row.film) & (df.sent_idx == row.sent_idx)].copy(),
-                                              sent_sim=self.run_sent_sim)
-                    out_df['thres_metric'] = 'sent-major-minor'
-                    self.thres_dfs[t] = pd.concat([self.thres_dfs[t], out_df])
-
-                if self.run_basic_thres:
-                    out_df = self.find_groups(df[(df.film == row.film) & (df.sent_idx == row.sent_idx)].copy(),
-                                              basic_thres=self.run_basic_thres)
-                    out_df['thres_metric'] = 'basic'
-                    self.thres_dfs[t] = pd.concat([self.thres_dfs[t], out_df])
+            out_dfs = []
+            for t_metric, shift_table in shift_tables.items():
+                out_df = self.gold_df.copy()
+                out_df['labels'] = np.where(shift_table[t_idx], 'creative shift', 'reproduction').tolist()
+                out_df['thres_metric'] = t_metric
+                out_dfs.append(out_df)
+            self.thres_dfs[t] = pd.concat(out_dfs).iloc[order]
+
+    def threshold_metrics(self) -> dict:
+        '''Returns the labeling options (see sentenceGroups.shift_table)
+        of every threshold metric that is tested.
+        '''
+        t_metrics = {'word-major-minor': {}}
+        if self.run_sent_sim:
+            t_metrics['sent-major-minor'] = {'sent_sim': True}
+        if self.run_basic_thres:
+            t_metrics['basic'] = {'simple_thres': True}
+        return t_metrics
+
+    def gold_matches(self, df:pd.DataFrame, on=['film', 'sent_idx', 'src']):
+        '''Returns the position in a given dataframe of the first row
+        that matches every gold row on the given columns (joined at
+        once), -1 for gold rows without a match.
+        '''
+        firsts = df[on].assign(pos=np.arange(len(df))).drop_duplicates(on)
+        matched = self.gold[on].merge(firsts, how='left', on=on)
+        return matched.pos.fillna(-1).to_numpy().astype(np.int64)
 
     def score(self):
         self.thres_reports = {}
+        gold = self.gold[self.human_label].str.lower().to_list()
         for threshold, df in self.thres_dfs.items():
             t_metric_reports = {}
             for t_metric in df['thres_metric'].unique():
-                pred = []
-                gold = []
-                for idx, row in self.gold.iterrows():
-                    try:
-                        cur_gold = row[self.human_label].lower()
-                        gold.append(cur_gold)
-
-                        cur_pred = df[
-                            (df.sent_idx == row.sent_idx)
-                            & (df.src == row.src)
-                            & (df['thres_metric'] == t_metric)
-                        ]['labels'].to_list()[0]
-                        pred.append(cur_pred)
-                    except Exception:
-                        print('PROBLEM FOUND:\n')
-                        print(idx, row)
-                        print(df[(df.sent_idx == idx) & (df.src == row.src)])
-                        return
-
+                metric_df = df[df['thres_metric'] == t_metric]
+                matches = self.gold_matches(metric_df)
+                if (matches == -1).any():
+                    idx = np.flatnonzero(matches == -1)[0]
+                    print('PROBLEM FOUND:\n')
+                    print(idx, self.gold.iloc[idx])
+                    return
+
+                pred = metric_df['labels'].to_numpy()[matches].tolist()
                 t_metric_reports[t_metric] = report(gold, pred, output_dict=True)
 
             self.thres_reports[threshold] = t_metric_reports
@@ -90,6 +277,208 @@ class ThresholdFinder:
     def get_best(self):
         return self.comp_df[self.comp_df['f1-score'] == self.comp_df['f1-score'].max()]
 
+    def gold_rows(self):
+        '''Returns the row in gold_df of the word of every gold row,
+        the first word of its sentence with the same source word.
+        '''
+        words = pd.DataFrame({'gold_pos': self.gold_pos,
+                              'src': self.gold_df.src.to_numpy(),
+                              'row': np.arange(len(self.gold_df))})
+        words = words.drop_duplicates(['gold_pos', 'src'])
+        gold_words = pd.DataFrame({'gold_pos': np.arange(len(self.gold)),
+                                   'src': self.gold.src.to_numpy()})
+        gold_words = gold_words.merge(words, how='left', on=['gold_pos', 'src'])
+        if gold_words.row.isna().any():
+            raise ValueError(f'Gold rows without a scored word: '
+                             f'{np.flatnonzero(gold_words.row.isna()).tolist()}')
+        return gold_words.row.to_numpy().astype(np.int64)
+
+    def sweep_inputs(self):
+        '''Returns whether every gold label is a creative shift, the
+        sweep keys and threshold independent predictions of every gold
+        row per threshold metric (see sentenceGroups.shift_keys), and
+        the genre and film of every gold row.
+        '''
+        rows = self.gold_rows()
+        gold_shift = self.gold[self.human_label].str.lower().to_numpy() == 'creative shift'
+
+        t_metrics = self.threshold_metrics()
+        metric_keys = {t_metric: self.groups.shift_keys(rows, **options)
+                       for t_metric, options in t_metrics.items()}
+
+        gold_groups = pd.DataFrame({'genre': self.gold_df.genre.to_numpy()[rows],
+                                    'film': self.gold.film.to_numpy()})
+        return gold_shift, metric_keys, gold_groups
+
+    def sweep(self):
+        '''Tests every distinct threshold of every threshold metric on
+        the gold data (see sweep_thresholds) and returns the best
+        thresholds. The full curves are stored in sweep_df.
+        '''
+        gold_shift, metric_keys, _ = self.sweep_inputs()
+
+        sweep_dfs = []
+        for t_metric, (keys, const_shift) in metric_keys.items():
+            sweep_df = sweep_thresholds(keys, gold_shift, const_shift)
+            sweep_df['t_metric'] = t_metric
+            sweep_dfs.append(sweep_df)
+        self.sweep_df = pd.concat(sweep_dfs)
+
+        return self.sweep_df[self.sweep_df['f1-score'] == self.sweep_df['f1-score'].max()]
+
+    def group_sweep(self, by=['genre', 'film'], workers=1) -> pd.DataFrame:
+        '''Returns a dataframe with the best threshold and its scores
+        for every threshold metric of all gold rows and of the gold rows
+        of every group of the given group columns (such as every genre
+        and every film).
+
+        The sweep keys of the gold rows are found once (see
+        sweep_inputs) and every group only sweeps its own rows, in a
+        process pool if more than one worker is given. The table is
+        stored in group_df.
+        '''
+        gold_shift, metric_keys, gold_groups = self.sweep_inputs()
+
+        group_rows = [('all', 'all', np.arange(len(gold_shift)))]
+        for group_by in by:
+            for group, rows in gold_groups.groupby(group_by, sort=True).indices.items():
+                group_rows.append((group_by, group, rows))
+
+        names = []
+        sweep_args = []
+        for group_by, group, rows in group_rows:
+            for t_metric, (keys, const_shift) in metric_keys.items():
+                names.append((group_by, group, t_metric, len(np.unique(gold_shift[rows]))))
+                sweep_args.append((keys[rows], gold_shift[rows], const_shift[rows]))
+
+        if workers <= 1:
+            results = [best_threshold(i) for i in sweep_args]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(best_threshold, sweep_args,
+                                        chunksize=max(1, len(sweep_args) // (4 * workers))))
+
+        self.group_df = pd.DataFrame(
+            [name + tuple(result) for name, result in zip(names, results)],
+            columns=['group_by', 'group', 't_metric', 'gold_classes', 'threshold',
+                     'precision', 'recall', 'f1-score', 'support'],
+        )
+        return self.group_df
+
+    def cross_validate(self, folds=5, by=None, seed=None, workers=1) -> pd.DataFrame:
+        '''Returns a dataframe with the held-out scores of a threshold
+        selected on the other gold rows, for k random folds or for every
+        group of a given group column (such as film, which leaves one
+        film out at a time).
+
+        Every fold selects the best threshold metric and threshold on
+        its training rows from the sweep keys (see sweep_inputs), which
+        are found once, and the folds are run in a process pool if more
+        than one worker is given. The last row (fold all) scores the
+        held-out predictions of all folds together, the table is stored
+        in cv_df.
+        '''
+        gold_shift, metric_keys, gold_groups = self.sweep_inputs()
+        n_rows = len(gold_shift)
+        if by is None:
+            test_rows = np.array_split(np.random.default_rng(seed).permutation(n_rows), folds)
+            fold_names = list(range(len(test_rows)))
+        else:
+            group_rows = gold_groups.groupby(by, sort=True).indices
+            fold_names = list(group_rows)
+            test_rows = list(group_rows.values())
+
+        fold_args = []
+        for rows in test_rows:
+            train = np.ones(n_rows, dtype=bool)
+            train[rows] = False
+            fold_args.append((metric_keys, gold_shift, train))
+
+        if workers <= 1:
+            results = [fold_shifts(i) for i in fold_args]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(fold_shifts, fold_args))
+
+        cv_rows = []
+        held_out = np.zeros(n_rows, dtype=bool)
+        for fold, rows, ((t_metric, threshold, train_f1), shifts) in zip(fold_names, test_rows, results):
+            # The held-out predictions are in row order
+            rows = np.sort(rows)
+            held_out[rows] = shifts
+            cv_rows.append([fold, t_metric, threshold, train_f1]
+                           + shift_scores(shifts, gold_shift[rows]))
+        cv_rows.append(['all', None, np.nan, np.nan]
+                       + shift_scores(held_out, gold_shift))
+
+        self.cv_df = pd.DataFrame(cv_rows, columns=['fold', 't_metric', 'threshold', 'train_f1',
+                                                    'precision', 'recall', 'f1-score', 'support'])
+        return self.cv_df
+
+    def bootstrap(self, n_resamples=10000, alpha=.05, seed=None,
+                  chunk_size=1000) -> pd.DataFrame:
+        '''Returns a dataframe with a bootstrap confidence interval of
+        the macro f1-score of every distinct threshold of every threshold
+        metric (as in sweep), and how often it is the best threshold.
+
+        All resamples of the gold rows are drawn as one index matrix
+        (in chunks of chunk_size resamples), which is turned into a count
+        of every gold row per resample. The confusion counts of every
+        (resample, threshold) pair are then the products of these counts
+        with the predictions of every threshold. best_share is the share
+        of resamples in which the threshold has the best f1-score of all
+        thresholds and metrics (the first one on a tie), the
+        table is stored in boot_df.
+        '''
+        gold_shift, metric_keys, _ = self.sweep_inputs()
+        n_rows = len(gold_shift)
+        rng = np.random.default_rng(seed)
+
+        # The prediction of every (threshold, gold row) pair per metric
+        t_metrics = []
+        thresholds = []
+        preds = []
+        for t_metric, (keys, const_shift) in metric_keys.items():
+            metric_thresholds = np.append(-np.inf, np.unique(keys[~np.isnan(keys)]))
+            with np.errstate(invalid='ignore'):
+                pred = np.where(np.isnan(keys), const_shift, keys > metric_thresholds[:, None])
+            t_metrics += [t_metric] * len(metric_thresholds)
+            thresholds.append(metric_thresholds)
+            preds.append(pred)
+        thresholds = np.concatenate(thresholds)
+        preds = np.concatenate(preds).astype(np.float64)
+
+        boot_f1 = []
+        for c_start in range(0, n_resamples, chunk_size):
+            n_chunk = min(chunk_size, n_resamples - c_start)
+            resamples = rng.integers(0, n_rows, size=(n_chunk, n_rows))
+            counts = np.bincount((resamples + n_rows * np.arange(n_chunk)[:, None]).ravel(),
+                                 minlength=n_chunk * n_rows).reshape(n_chunk, n_rows)
+
+            tp = (counts * gold_shift) @ preds.T
+            fp = (counts * ~gold_shift) @ preds.T
+            n_gold = (counts @ gold_shift.astype(np.float64))[:, None]
+            fn = n_gold - tp
+            tn = n_rows - n_gold - fp
+            boot_f1.append(macro_scores(tp, fp, fn, tn)[2])
+        boot_f1 = np.concatenate(boot_f1)
+
+        tp = preds @ gold_shift
+        fp = preds @ ~gold_shift
+        fn = gold_shift.sum() - tp
+        tn = n_rows - gold_shift.sum() - fp
+        best_counts = np.bincount(boot_f1.argmax(axis=1), minlength=len(thresholds))
+
+        self.boot_df = pd.DataFrame({
+            't_metric': t_metrics,
+            'f1-score': macro_scores(tp, fp, fn, tn)[2],
+            'boot_mean': boot_f1.mean(axis=0),
+            'ci_low': np.quantile(boot_f1, alpha / 2, axis=0),
+            'ci_high': np.quantile(boot_f1, 1 - alpha / 2, axis=0),
+            'best_share': best_counts / n_resamples,
+        }, index=thresholds)
+        return self.boot_df
+
     def store(self, overwrite: bool|str=False):
         if not overwrite:
             thres_choice = self.best_thres
@@ -126,56 +515,13 @@ class ThresholdFinder:
 
     def find_groups(self, df_sent, sent_sim=False, basic_thres=False):
         grp = df_sent.cosine_w.to_list()
-        unique_scores = set(grp)
+        groups = sentenceGroups(grp, cosine_sent=df_sent.cosine_sent if sent_sim else None)
+        if groups.failed.any() and not basic_thres:
+            print(f'JENKSPY_ERROR: {grp}')
+            raise ValueError(f'Could not find the natural breaks of {grp}')
 
-        if basic_thres:
-            df_sent['labels'] = [self.find_label(i.cosine_w) for idx, i in df_sent.iterrows()]
-        else:
-            if len(unique_scores) == 1:
-                df_sent['labels'] = self.find_label(list(unique_scores)[0])
-            else:
-                try:
-                    breaks = jenkspy.jenks_breaks(grp, n_classes=2)
-                except Exception:
-                    print(f'JENKSPY_ERROR: {grp}')
-                groups = [breaks[i:i+2] for i in range(len(breaks)) if not i + 2 > len(breaks)]
-
-                lst = []
-                for idx, i in df_sent.iterrows():
-                    for j_idx, mima_i in enumerate(groups):
-                        if j_idx == 0 and mima_i[0] <= i.cosine_w <= mima_i[1]:
-                            lst.append('lower')
-                        elif mima_i[0] < i.cosine_w <= mima_i[1]:
-                            lst.append('higher')
-                df_sent['groups'] = lst
-
-                major_group = Counter(lst).most_common(1)[0][0]
-
-                if sent_sim:
-                    major_label = self.find_label(df_sent.cosine_sent.unique()[0])
-                else:
-                    major_label = self.find_label(mean(df_sent[df_sent.groups == major_group].cosine_w.to_list()))
-
-                if major_label == 'creative shift':
-                    if major_group == 'higher':
-                        minor_label = 'reproduction'
-                    else:
-                        minor_label = 'creative shift'
-                else:
-                    if major_group == 'higher':
-                        minor_label = 'reproduction'
-                    else:
-                        minor_label = 'creative shift'
-
-                group_labels = []
-                for idx, i in df_sent.iterrows():
-                    if i.groups == major_group:
-                        group_labels.append(major_label)
-                    else:
-                        group_labels.append(minor_label)
-                df_sent['labels'] = group_labels
-
-                df_sent.drop(['groups'], axis=1, inplace=True)
+        df_sent['labels'] = groups.labels(self.cur_thres, sent_sim=sent_sim,
+                                          simple_thres=basic_thres)
 
         return df_sent
 
@@ -198,6 +544,17 @@ class StaticThres(ThresholdFinder):
             out_df['thres_metric'] = 'basic'
             self.thres_dfs[t] = out_df
 
+    def sweep_inputs(self):
+        '''Returns whether every gold label is a creative shift, the
+        static cosine score and threshold independent prediction (none)
+        of every gold row, and the genre and film of every gold row (if
+        the gold data has them).
+        '''
+        gold_shift = self.gold['human_label'].str.lower().to_numpy() == 'creative shift'
+        keys = self.gold.static_cosine.to_numpy(dtype=np.float64)
+        metric_keys = {'basic': (keys, np.zeros(len(keys), dtype=bool))}
+        return gold_shift, metric_keys, self.gold[[i for i in ['genre', 'film'] if i in self.gold]]
+
     def static_thres(self, cosine_score):
         if cosine_score > self.cur_thres:
             return 'Creative Shift'
@@ -225,83 +582,132 @@ class StaticThres(ThresholdFinder):
 
 
 class ContextualThres(ThresholdFinder):
-    def best_df(self):
+    def best_df(self, workers=1):
+        '''Returns the full score dataframe labeled with the best
+        threshold and threshold metric.
+
+        The words of every (film, sent_idx) sentence are grouped on
+        their own, one film at a time, and the films are labeled in a
+        process pool if more than one worker is given.
+        '''
         self.cur_thres = self.get_best().index[0]
         thres_metric = self.get_best().iloc[0].t_metric
-
-        if thres_metric == 'word-major-minor':
-            return self.find_groups(self.orig_df.copy())
-
-        elif thres_metric == 'sent-major-minor':
-            return self.find_groups(self.orig_df.copy(),
-                                      sent_sim=True)
-
-        elif thres_metric == 'basic':
-            return self.find_groups(self.orig_df.copy(),
-                                      basic_thres=True)
+        options = self.threshold_metrics()[thres_metric]
+
+        scores = self.orig_df.cosine_w.to_numpy()
+        sent_idxs = self.orig_df.sent_idx.to_numpy()
+        cosine_sent = self.orig_df.cosine_sent.to_numpy()
+        film_rows = list(self.orig_df.groupby('file', sort=False).indices.values())
+        film_args = lambda rows : (scores[rows], sent_idxs[rows], cosine_sent[rows],
+                                   self.cur_thres, options)
+
+        shifts = np.zeros(len(self.orig_df), dtype=bool)
+        if workers <= 1:
+            for rows in film_rows:
+                shifts[rows] = film_shifts(film_args(rows))
+        else:
+            # Only a few films per worker are sent at once to bound the memory
+            window = 4 * workers
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                for w_start in range(0, len(film_rows), window):
+                    w_rows = film_rows[w_start:w_start + window]
+                    for rows, film_shift in zip(w_rows, pool.map(film_shifts,
+                                                                 [film_args(i) for i in w_rows])):
+                        shifts[rows] = film_shift
+
+        out_df = self.orig_df.copy()
+        out_df['labels'] = np.where(shifts, 'creative shift', 'reproduction').tolist()
+        return out_df
 
     def retrieve_best_gold(self):
         df = self.thres_dfs[self.get_best().index[0]]
         thres_metric = self.get_best().iloc[0].t_metric
 
-        for idx, row in self.gold.iterrows():
-            cur_df = df[
-                (df.sent_idx == row.sent_idx)
-                & (df.src == row.src)
-                & (df['thres_metric'] == thres_metric)
-            ].head(1).copy()
-
-            cur_df['human_label'] = row.label_context
-
-            if idx == 0:
-                best_gold = cur_df
-
-            else:
-                best_gold = pd.concat([best_gold, cur_df])
+        metric_df = df[df['thres_metric'] == thres_metric]
+        matches = self.gold_matches(metric_df)
+        best_gold = metric_df.iloc[matches[matches != -1]].copy()
+        best_gold['human_label'] = self.gold.label_context.to_numpy()[matches != -1]
 
         return best_gold
 
 class SyntaxThres(ThresholdFinder):
+    # The label column and score column of every syntactic metric
+    t_metrics = {
+        'sacr_cross_label': 'sacr_cross_score',
+        'label_label': 'label_changes',
+        'astred_label': 'astred_score',
+    }
+
     def __init__(self, thresholds=[.4, .45, .5, .55, .6],
                  human_label='human_label') -> None:
         self.thresholds = thresholds
         self.human_label = human_label
 
     def __call__(self, df:pd.DataFrame):
-        self.thres_dfs = {}
-        for t in self.thresholds:
-            self.cur_thres = t
-            cur_df = df.copy()
-            for i in range(len(df)):
-                cur_df.at[i, 'sacr_cross_label'] = self.find_label(cur_df.iloc[i].sacr_cross_score)
-                cur_df.at[i, 'label_label'] = self.find_label(cur_df.iloc[i].label_changes)
-                cur_df.at[i, 'astred_label'] = self.find_label(cur_df.iloc[i].astred_score)
-                cur_df.at[i, 'thres_metric'] = 'basic'
+        self.orig_df = df
 
-            self.thres_dfs[t] = cur_df
+        # All thresholds and metrics are labeled at once in a
+        # (threshold x metric x row) cube of creative shifts, the labeled
+        # dataframe of a threshold is only made when it is needed
+        scores = df[list(self.t_metrics.values())].to_numpy(dtype=np.float64).T
+        self.label_cube = scores[None, :, :] > np.asarray(self.thresholds, dtype=np.float64)[:, None, None]
+
+    def thres_df(self, threshold:float) -> pd.DataFrame:
+        '''Returns the score dataframe with the labels of every
+        syntactic metric for a given threshold.
+        '''
+        t_idx = list(self.thresholds).index(threshold)
+        self.cur_thres = threshold
+        cur_df = self.orig_df.copy()
+        for m_idx, t_metric in enumerate(self.t_metrics):
+            cur_df[t_metric] = self.cube_labels(t_idx, m_idx)
+        cur_df['thres_metric'] = 'basic'
+        return cur_df
+
+    def cube_labels(self, t_idx:int, m_idx:int) -> list:
+        '''Returns the labels of a given threshold and metric position
+        in the label cube.
+        '''
+        return np.where(self.label_cube[t_idx, m_idx], 'creative shift', 'reproduction').tolist()
+
+    def sweep_inputs(self):
+        '''Returns whether every gold label is a creative shift, the
+        score and threshold independent prediction (none) of every row
+        per syntactic metric, and the genre and film of every row (if
+        the scores have them).
+        '''
+        gold_shift = self.orig_df[self.human_label].str.lower().to_numpy() == 'creative shift'
+        no_const = np.zeros(len(gold_shift), dtype=bool)
+        metric_keys = {t_metric: (self.orig_df[score_col].to_numpy(dtype=np.float64), no_const)
+                       for t_metric, score_col in self.t_metrics.items()}
+        gold_groups = self.orig_df[[i for i in ['genre', 'film'] if i in self.orig_df]]
+        return gold_shift, metric_keys, gold_groups
 
     def score(self):
-        self.thres_reports = {}
-        for threshold, df in self.thres_dfs.items():
-            t_metric_reports = {}
-            gold = df[self.human_label].to_list()
-            for t_metric in ['sacr_cross_label', 'label_label', 'astred_label']:
-                pred = []
-                for idx, row in df.iterrows():
-                    pred.append(row[t_metric])
-
-                t_metric_reports[t_metric] = report(gold, pred, output_dict=True)
-
-            self.thres_reports[threshold] = t_metric_reports
-
-        for rep_cnt, (threshold, t_metrics) in enumerate(self.thres_reports.items()):
-            for metric_cnt, (t_metric, rep) in enumerate(t_metrics.items()):
-                out_df = pd.DataFrame(rep['macro avg'], index=[threshold])
-                out_df['t_metric'] = t_metric
-                if rep_cnt == 0 and metric_cnt == 0:
-                    self.comp_df = out_df
-                else:
-                    self.comp_df = pd.concat([self.comp_df, out_df])
+        '''Scores every threshold and metric of the label cube at once
+        from its confusion counts (see macro_scores) into comp_df. The
+        full classification report is only made for the best threshold
+        and metric, in thres_reports.
+        '''
+        gold = self.orig_df[self.human_label].to_list()
+        gold_shift = self.orig_df[self.human_label].str.lower().to_numpy() == 'creative shift'
+        tp = (self.label_cube & gold_shift).sum(-1)
+        fp = self.label_cube.sum(-1) - tp
+        fn = gold_shift.sum() - tp
+        tn = len(gold_shift) - tp - fp - fn
+        precision, recall, f1 = macro_scores(tp, fp, fn, tn)
+
+        self.comp_df = pd.DataFrame({
+            'precision': precision.ravel(),
+            'recall': recall.ravel(),
+            'f1-score': f1.ravel(),
+            'support': len(gold_shift),
+            't_metric': list(self.t_metrics) * len(self.thresholds),
+        }, index=np.repeat(self.thresholds, len(self.t_metrics)))
+
+        best = self.get_best().iloc[0]
+        labels = self.cube_labels(list(self.thresholds).index(best.name), list(self.t_metrics).index(best.t_metric))
+        self.thres_reports = {best.name: {best.t_metric: report(gold, labels, output_dict=True)}}
 
     def get_best(self):
         return self.comp_df[self.comp_df['f1-score'] == self.comp_df['f1-score'].max()]
@@ -313,7 +719,7 @@ class SyntaxThres(ThresholdFinder):
             thres_choice = overwrite
 
         try:
-            self.thres_dfs[thres_choice].to_csv(
+            self.thres_df(thres_choice).to_csv(
                 f'{name_timestamp()}-{thres_choice}-context.tsv',
                 sep='\t',
             )
@@ -334,4 +740,4 @@ class SyntaxThres(ThresholdFinder):
             return 'reproduction'
 
     def best_df(self):
-        return self.thres_dfs[self.get_best().index[0]]
+        return self.thres_df(self.get_best().index[0])